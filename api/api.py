@@ -1,7 +1,10 @@
 import asyncio
 import json
+import logging
 import os
+import uuid
 from asyncio import wait_for
+from datetime import datetime
 
 import sentry_sdk
 import tornado
@@ -9,13 +12,17 @@ import tornado.ioloop
 import tornado.web
 from aiocache import Cache, cached
 from aiohttp import ClientError
+from tornado.iostream import StreamClosedError
 from tornado.log import enable_pretty_logging
 
 from gliders import weglide_find_closest_gliders
-from misc import set_upload_status
+from ledger import get_uploaded
+from misc import cache_telemetry
 from olc_interface import OlcInterface, OlcRequestError
-from drr_scheduler import drr_scheduler
-from upload import upload_flight
+from drr_scheduler import drr_scheduler, lanes
+from upload_events import upload_event_hub
+from upload_jobs import claim_idempotency_key, create_upload_job, delete_upload_job, get_upload_job, get_upload_job_progress, set_job_flight_status
+from upload_queue import get_upload_eta, upload_pipeline, upload_queue
 
 enable_pretty_logging()
 root = os.path.dirname(__file__)
@@ -40,6 +47,37 @@ class BaseHandler(tornado.web.RequestHandler):
             }))
 
 
+def weglide_link(weglide_flight_id, text='View'):
+    return f'<a target="_blank" href="https://www.weglide.org/flight/{weglide_flight_id}">{text}</a>'
+
+
+def listed_upload(flight):
+    """Upload of a flight as listed by fetch_flights, the way the frontend submits it."""
+    return {
+        'id': flight['id'],
+        'date': flight['date'],
+        'pilot': flight['pilot']['firstName'] + ' ' + flight['pilot']['surName'],
+        'co_pilot': flight.get('co_pilot_name'),
+        'airplane_weglide': flight['airplane_weglide'],
+        'registration': flight.get('registration'),
+        'competition_id': flight.get('competition_id'),
+        'distance': flight['distanceInKm'],
+        'pilot_comment': flight.get('pilot_comment'),
+    }
+
+
+async def fetch_all_flights(user_id, start_year, end_year=None, scrape=True):
+    """Flights of all seasons from start_year on, following the cursor over every capped page."""
+    flights = []
+    async with OlcInterface() as olc:
+        while True:
+            page, cursor = await olc.fetch_flights_page(user_id, start_year, end_year, _scrape=scrape)
+            flights += page
+            if cursor is None or (end_year and cursor >= end_year):
+                return flights
+            end_year = cursor
+
+
 class UploadFlightsHandler(BaseHandler):
     async def post(self, *args, **kwargs):
         global sentry_upload_users
@@ -55,17 +93,80 @@ class UploadFlightsHandler(BaseHandler):
         weglide_dateofbirth = body.get('weglide_dateofbirth')
         olc_user = body.get('olc_user')
         olc_password = body.get('olc_password')
+        olc_user_id = body.get('user_id') and int(body['user_id'])
+        # Resume a migration: only the flights not in the ledger yet, all listed flights when none are given.
+        # Without resume the selected flights are uploaded even when in the ledger, e.g. after deleting them on WeGlide.
+        resume = bool(body.get('resume'))
+        flights = body.get('flights')
 
         sentry_sdk.set_user({'id': weglide_user_id})
 
         with sentry_sdk.start_span(op='request', name='upload_flight') as span:
-            for flight in body['flights']:
-                set_upload_status(int(flight['id']), 'Pending', 'processing')  # Reset status
-                # loop.spawn_callback(upload_flight, flight)
-                drr_scheduler.enqueue_one(
-                    weglide_user_id,
-                    upload_flight(flight, weglide_user_id, weglide_dateofbirth, olc_user, olc_password)
-                )
+            job_id = uuid.uuid4().hex
+            idempotency_key = self.request.headers.get('Idempotency-Key') or body.get('idempotency_key')
+            listed = []
+            if resume and not flights and olc_user_id and body.get('start_year'):
+                # Every listed flight, usually cached, the frontend listed the same seasons before
+                try:
+                    listed = await fetch_all_flights(olc_user_id, int(body['start_year']), body.get('end_year') and int(body['end_year']))
+                except asyncio.TimeoutError:
+                    raise tornado.web.HTTPError(408, 'Took too long to fetch flights from OLC, try less flights at once')
+                except OlcRequestError as e:
+                    raise tornado.web.HTTPError(400, str(e))
+                flights = [listed_upload(flight) for flight in listed]
+            elif flights and olc_user_id:
+                # Only the seasons of the selected flights and without scraping, just for their pilot.
+                # A season runs from October, so flights late in a year may be in the next one.
+                years = [int(flight['date'][:4]) for flight in flights if flight.get('date')]
+                try:
+                    if years:
+                        last_season = int(body.get('end_year') or datetime.now().year)
+                        listed = await fetch_all_flights(olc_user_id, min(years), min(max(years) + 1, last_season), scrape=False)
+                except (asyncio.TimeoutError, OlcRequestError) as e:
+                    logging.info(f'Could not list flights of OLC user {olc_user_id}, not adding them to the ledger: {e}')
+            # The ledger of a flight is the one of its pilot according to OLC, the user_id in the request is not trusted
+            pilots = {int(flight['id']): flight['pilot']['id'] for flight in listed if flight.get('pilot', {}).get('id')}
+            if not flights:
+                raise tornado.web.HTTPError(400, 'No flights selected')
+            # A flight selected twice is uploaded once
+            flights = list({int(flight['id']): flight for flight in flights}.values())
+            uploaded = {}
+            if resume and olc_user_id:
+                # Flights the ledger has on WeGlide already are not transferred again
+                uploaded = await get_uploaded(olc_user_id, [flight['id'] for flight in flights])
+                flights = [flight for flight in flights if int(flight['id']) not in uploaded]
+            span.set_data('already_on_weglide', len(uploaded))
+            # One job record holds the state of all flights, polled at /upload_job or pushed to /upload_events
+            await create_upload_job(weglide_user_id, [int(flight['id']) for flight in flights], job_id)
+            if idempotency_key:
+                # Claimed once the job exists, so a concurrent duplicate always finds the job it lost to
+                earlier_job_id = await claim_idempotency_key(weglide_user_id, idempotency_key, job_id)
+                if earlier_job_id and await get_upload_job_progress(earlier_job_id):
+                    # Retried request, the flights are already on their way
+                    await delete_upload_job(job_id)
+                    span.set_data('idempotent_replay', True)
+                    self.write({'job_id': earlier_job_id, 'replayed': True})
+                    return
+            span.set_data('job_id', job_id)
+            # Durable queue, any API or worker process picks the uploads up, also after a restart.
+            # Flights of this user already queued by an earlier submission are merged, not uploaded twice.
+            queued, merged, inflight = await upload_queue.enqueue(weglide_user_id, job_id, [{
+                'flight': flight,
+                'weglide_user_id': weglide_user_id,
+                'weglide_dateofbirth': weglide_dateofbirth,
+                'olc_user': olc_user,
+                'olc_password': olc_password,
+                'olc_user_id': pilots.get(int(flight['id'])),
+            } for flight in flights]) if flights else (0, 0, [])
+            span.set_data('merged', merged)
+            for upload_id in inflight:
+                # Still processing, the job follows the upload and gets its outcome
+                flight_id = int(upload_id.rpartition(':')[2])
+                await set_job_flight_status(job_id, flight_id, 'Already being uploaded by an earlier submission')
+            self.write({
+                'job_id': job_id, 'queued': queued, 'merged': merged, 'already_uploading': len(inflight),
+                'already_on_weglide': len(uploaded),
+            })
             # TODO fix this to count only successful uploads
             # flight_count = len(body['flights'])
             #
@@ -85,15 +186,78 @@ class UploadFlightsHandler(BaseHandler):
 
 
 class UploadStatusHandler(BaseHandler):
-    def get(self):
-        from misc import get_upload_status
+    async def get(self):
+        from misc import get_upload_statuses
         flight_ids_str = self.get_argument('flight_ids')
         flight_ids_list = [int(flight_id) for flight_id in flight_ids_str.split(',')]
-        statuses = {flight_id: get_upload_status(flight_id) for flight_id in flight_ids_list}
+        statuses = await get_upload_statuses(flight_ids_list)
         if statuses:
             self.write(statuses)
 
 
+class UploadJobHandler(BaseHandler):
+    async def get(self):
+        job = await get_upload_job(self.get_argument('job_id'))
+        if job is None:
+            raise tornado.web.HTTPError(404, 'Upload job not found or expired')
+        self.write(job)
+
+
+class UploadCancelHandler(BaseHandler):
+    """Cancel flights of a job that are still queued, all of them when no flight_ids are given."""
+    async def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, 'Invalid JSON')
+        job = await get_upload_job(body.get('job_id', ''))
+        if job is None:
+            raise tornado.web.HTTPError(404, 'Upload job not found or expired')
+        flight_ids = body.get('flight_ids') or [
+            flight_id for flight_id, flight in job['flights'].items() if flight['status'] == 'processing'
+        ]
+        cancelled = await upload_queue.cancel(job['weglide_user_id'], job['job_id'], [int(f) for f in flight_ids])
+        for flight_id in cancelled:
+            await set_job_flight_status(job['job_id'], flight_id, 'Cancelled', 'cancelled')
+        self.write({'cancelled': cancelled})
+
+
+class UploadEtaHandler(BaseHandler):
+    """Queue position and ETA of a job, counters only so it is cheap to poll."""
+    async def get(self):
+        eta = await get_upload_eta(self.get_argument('job_id'))
+        if eta is None:
+            raise tornado.web.HTTPError(404, 'Upload job not found or expired')
+        self.write(eta)
+
+
+class UploadEventsHandler(BaseHandler):
+    """Server-Sent Events stream of status changes of an upload job, /upload_job stays as fallback."""
+    keepalive_seconds = 15
+
+    async def get(self):
+        job_id = self.get_argument('job_id')
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')  # Do not buffer in nginx
+
+        queue = upload_event_hub.subscribe(job_id)
+        try:
+            self.write('retry: 5000\n\n')
+            await self.flush()
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=self.keepalive_seconds)
+                    self.write(f'data: {event}\n\n')
+                except asyncio.TimeoutError:
+                    self.write(': keepalive\n\n')
+                await self.flush()
+        except StreamClosedError:
+            pass
+        finally:
+            upload_event_hub.unsubscribe(job_id, queue)
+
+
 class FetchFlightsHandler(BaseHandler):
     async def get(self):
         user_id = self.get_argument('user_id')
@@ -112,16 +276,22 @@ class FetchFlightsHandler(BaseHandler):
         async with OlcInterface() as olc:
             try:
                 # TODO enforce timeout?
-                future = drr_scheduler.enqueue_one(
-                    user_id,
-                    olc.fetch_flights(user_id, start_year, end_year),
-                )
-                flights = await future
+                # The OLC requests inside are queued per user in the olc_json and olc_html lanes
+                flights, cursor = await olc.fetch_flights_page(user_id, start_year, end_year)
             except asyncio.TimeoutError:
                 raise tornado.web.HTTPError(408, 'Took too long to fetch flights from OLC, try less flights at once')
             except OlcRequestError as e:
                 raise tornado.web.HTTPError(400, str(e))
             else:
+                if cursor is not None:
+                    # Older seasons were not fetched because of the flights cap, pass as end_year to continue
+                    self.set_header('X-Next-End-Year', str(cursor))
+                # Flights uploaded by an earlier migration are unselected, copied as the listing is cached
+                uploaded = await get_uploaded(user_id, [flight['id'] for flight in flights])
+                flights = [
+                    dict(flight, checked=False, weglide_id=uploaded[int(flight['id'])], result=weglide_link(uploaded[int(flight['id'])], 'Already on WeGlide'))
+                    if int(flight['id']) in uploaded else flight for flight in flights
+                ]
                 self.write(json.dumps(flights))
 
 
@@ -140,7 +310,7 @@ class AppStatus(BaseHandler):
             self.set_status(500)
 
         inflight, cap = drr_scheduler.global_load()
-        s_mean, s50, s90 = drr_scheduler.service_times()
+        s_mean, s50, s90, s99 = drr_scheduler.service_times()
         active_users = drr_scheduler.active_user_count()
 
         with sentry_sdk.start_span(op='queue', name='app_status') as span:
@@ -149,14 +319,23 @@ class AppStatus(BaseHandler):
             span.set_data('s_mean', s_mean)
             span.set_data('s50', s50)
             span.set_data('s90', s90)
+            span.set_data('s99', s99)
             span.set_data('active_users', active_users)
 
         # r_user, share = drr_scheduler.user_effective_rate(user_id)
         result["upstream_load"] = {"inflight": inflight, "cap": cap}
-        result["service_time_sec"] = {"mean": s_mean, "p50": s50, "p90": s90}
+        result["service_time_sec"] = {"mean": s_mean, "p50": s50, "p90": s90, "p99": s99}
+        result["service_time_sec_by_op"] = {
+            op: {"mean": mean, "p50": p50, "p90": p90, "p99": p99}
+            for op, (mean, p50, p90, p99) in drr_scheduler.service_times_by_op().items()
+        }
         # "your_rate_items_per_sec": r_user,
         # "your_share": share,
         result["active_users"] = active_users
+        result["lanes"] = lanes.snapshot()
+        result["upload_queue"] = await upload_queue.stats()
+        result["upload_pipeline"] = upload_pipeline.snapshot()
+        result["cache"] = cache_telemetry.snapshot()
 
         self.write(json.dumps(result))
 
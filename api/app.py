@@ -2,13 +2,13 @@ import logging
 import os
 
 import aiocache
-import redis
+import redis.asyncio
 import sentry_sdk
 import tornado
 from tornado import autoreload
 from tornado.log import enable_pretty_logging
 
-from drr_scheduler import drr_scheduler
+from drr_scheduler import drr_scheduler, lanes
 
 enable_pretty_logging()
 logging.basicConfig(level=logging.INFO)
@@ -16,7 +16,13 @@ local = os.environ.get('LOCAL', False)
 
 redis_host = os.environ.get('REDIS_HOST', 'localhost')
 redis_port = os.environ.get('REDIS_PORT', '6379')
-redis_client = redis.Redis(redis_host, redis_port, decode_responses=True)
+# Pooled async client, blocking calls would stall the IOLoop for every other request.
+# When all connections are in use, callers wait for one to be released (up to the timeout) instead of failing.
+redis_client = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+    host=redis_host, port=redis_port, decode_responses=True,
+    max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 64)),
+    timeout=float(os.environ.get('REDIS_POOL_TIMEOUT', 5)),
+))
 
 # Local, see production settings below
 aiocache.caches.set_config({
@@ -40,10 +46,12 @@ if not local:
         enable_logs=True,
     )
 
-    # Production settings
+    # Production settings, near cache keeps hot keys deserialized in-process in front of Redis
     aiocache.caches.set_config({
         'default': {
-            'cache': "aiocache.backends.redis.RedisCache",
+            'cache': "near_cache.NearRedisCache",
+            'near_max_size': int(os.environ.get('NEAR_CACHE_MAX_SIZE', 512)),
+            'near_ttl': int(os.environ.get('NEAR_CACHE_TTL', 30)),
             'serializer': {
                 'class': "misc.Lz4PickleSerializer"
             },
@@ -56,7 +64,7 @@ if not local:
 
 def make_app():
     # Aiocache will not work if imported before setting the config
-    from api import FetchFlightsHandler, UploadFlightsHandler, UploadStatusHandler, FindGliders, AppStatus
+    from api import FetchFlightsHandler, UploadFlightsHandler, UploadStatusHandler, UploadJobHandler, UploadCancelHandler, UploadEtaHandler, UploadEventsHandler, FindGliders, AppStatus
 
     settings = {
         'debug': local,
@@ -64,6 +72,10 @@ def make_app():
     return tornado.web.Application([
         (r"/upload_flights", UploadFlightsHandler),
         (r"/upload_status", UploadStatusHandler),
+        (r"/upload_job", UploadJobHandler),
+        (r"/upload_eta", UploadEtaHandler),
+        (r"/upload_cancel", UploadCancelHandler),
+        (r"/upload_events", UploadEventsHandler),
         (r"/fetch_flights", FetchFlightsHandler),
         (r"/find_gliders", FindGliders),
         (r"/status", AppStatus),
@@ -77,4 +89,8 @@ if __name__ == "__main__":
     autoreload.start()
     io_loop = tornado.ioloop.IOLoop.current()
     io_loop.spawn_callback(drr_scheduler.run)
+    io_loop.spawn_callback(lanes.run)
+    from upload_queue import upload_pipeline, upload_worker  # Like the handlers, only after the aiocache config
+    io_loop.spawn_callback(upload_pipeline.run)
+    io_loop.spawn_callback(upload_worker.run)
     io_loop.start()
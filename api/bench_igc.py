@@ -0,0 +1,61 @@
+"""Compare IGC parsing line by line against igc.parse_igc, with and without NumPy, on large IGC files.
+
+Usage: python bench_igc.py [hours]
+"""
+import random
+import sys
+import time
+from datetime import date
+
+import igc
+from standin_servers import make_igc
+
+
+def parse_lines(data):
+    """The straightforward way: split the file and read every B-record on its own."""
+    fixes = []
+    for line in data.decode('latin-1').splitlines():
+        if line.startswith('B') and len(line) >= 35:
+            fixes.append((
+                int(line[1:3]) * 3600 + int(line[3:5]) * 60 + int(line[5:7]),
+                (int(line[7:9]) + int(line[9:14]) / 60000) * (-1 if line[14] == 'S' else 1),
+                (int(line[15:18]) + int(line[18:23]) / 60000) * (-1 if line[23] == 'W' else 1),
+                int(line[25:30]), int(line[30:35]),
+            ))
+    return fixes
+
+
+def bench(fn, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return result, (time.perf_counter() - t0) / rounds * 1000
+
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rng = random.Random(42)
+    day = date(2024, 7, 1)
+    flight = {'date': day.isoformat(), 'distance': 100}
+    fixtures = {
+        f'{hours:g}h at 4s': make_igc(rng, day, int(hours * 900), 4).encode(),
+        f'{hours:g}h at 1s': make_igc(rng, day, int(hours * 3600), 1).encode(),
+        f'{hours * 2:g}h at 1s': make_igc(rng, day, int(hours * 7200), 1).encode(),
+    }
+    variants = [
+        ('lines', lambda data: parse_lines(data)),
+        ('stdlib', lambda data: igc.parse_igc(data, use_numpy=False)),
+    ]
+    if igc.np is not None:
+        variants.append(('numpy', lambda data: igc.parse_igc(data)))
+    else:
+        print('NumPy not installed, only the standard library path is measured')
+
+    print(f"{'fixture':<16}{'KiB':>8}{'fixes':>8}  {'parser':<12}{'parse ms':>10}{'flights ms':>12}")
+    for name, data in fixtures.items():
+        for variant, parse in variants:
+            track, parse_ms = bench(lambda: parse(data), 5)
+            flights_ms = f'{bench(lambda: igc.flights(track), 5)[1]:.1f}' if variant != 'lines' else ''
+            print(f'{name:<16}{len(data) / 1024:>8.0f}{len(track):>8}  {variant:<12}{parse_ms:>10.1f}{flights_ms:>12}')
+        _, ms = bench(lambda: igc.check_igc(data, flight), 5)
+        print(f"{name:<16}{'':>16}  {'check_igc':<12}{ms:>10.1f}")
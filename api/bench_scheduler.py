@@ -0,0 +1,60 @@
+"""Compare enqueue-to-start latency and idle CPU of the DRR dispatcher against the old 10ms polling loop.
+
+Usage: python bench_scheduler.py [items]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from drr_scheduler import AdaptiveCap, DRRScheduler
+
+
+class PollingDRRScheduler(DRRScheduler):
+    """The dispatcher as it was: poll every 10ms for work and capacity."""
+    async def run(self):
+        while True:
+            if self.inflight >= self.adaptive.cap:
+                await asyncio.sleep(0.01); continue
+            uid, item = self._pop_next()
+            if uid is None:
+                await asyncio.sleep(0.01); continue
+            self.inflight += 1
+            task = asyncio.ensure_future(self._execute(uid, item))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+async def measure(scheduler_class, items, idle_seconds=2.0):
+    scheduler = scheduler_class(AdaptiveCap(floor=4, ceiling=32))
+    runner = asyncio.ensure_future(scheduler.run())
+
+    # Idle: nothing queued, only the dispatcher is running
+    cpu0 = time.process_time()
+    await asyncio.sleep(idle_seconds)
+    idle_cpu = (time.process_time() - cpu0) / idle_seconds * 100
+
+    # Latency: enqueue one item at a time with a pause in between, like requests trickling in
+    latencies = []
+
+    async def item(enqueued):
+        latencies.append(time.perf_counter() - enqueued)
+
+    for i in range(items):
+        await scheduler.enqueue_one(i % 5, item(time.perf_counter()))
+        await asyncio.sleep(0.003)
+
+    runner.cancel()
+    latencies = sorted(l * 1000 for l in latencies)
+    return idle_cpu, statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+async def main(items):
+    print(f"{'dispatcher':<24}{'idle cpu %':>12}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for scheduler_class in (PollingDRRScheduler, DRRScheduler):
+        idle_cpu, mean, p50, p99 = await measure(scheduler_class, items)
+        print(f'{scheduler_class.__name__:<24}{idle_cpu:>12.2f}{mean:>10.3f}{p50:>10.3f}{p99:>10.3f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 300))
@@ -0,0 +1,75 @@
+"""Compare cache serializers on real-shaped OLC data.
+
+Usage: LOCAL=True python bench_serializers.py [flights]
+"""
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+from misc import ColumnarMsgpackSerializer, Lz4PickleSerializer
+
+first_names = ['Jan', 'Peter', 'Anna', 'Klaus', 'Marie', 'Tom', 'Sophie', 'Lars']
+surnames = ['de Vries', 'Müller', 'Jansen', 'Schmidt', 'Bakker', 'Weber', 'Visser']
+airplanes = ['ASG 29 (18m)', 'Discus 2b', 'LS 4', 'DG 800 S (15m)', 'ASK 21', 'Duo Discus', 'Ventus 2cT (18m)']
+clubs = ['Gliding Club Terlet', 'Aero Club Hamburg', 'ZC Noord', 'LSV Rinteln']
+takeoffs = ['Terlet', 'Venlo', 'Rinteln', 'Hamburg Boberg', 'Gliwice']
+
+
+def make_flight(rng, flight_id):
+    day = date(2024, 4, 1) + timedelta(days=rng.randint(0, 180))
+    pilot = {'id': rng.randint(1000, 99999), 'firstName': rng.choice(first_names), 'surName': rng.choice(surnames)}
+    airplane = rng.choice(airplanes)
+    flight = {
+        'id': str(flight_id),
+        'dateOfFlight': int(time.mktime(day.timetuple()) * 1000),
+        'date': day.isoformat(),
+        'airplane': airplane,
+        'airplane_weglide': {'name': airplane.split(' (')[0], 'id': rng.randint(1, 700)},
+        'registration': f'PH-{rng.randint(100, 999)}',
+        'competition_id': rng.choice(['A1', 'XG', 'K8', '']),
+        'distanceInKm': round(rng.uniform(50, 800), 1),
+        'speedInKmH': round(rng.uniform(40, 140), 1),
+        'points': round(rng.uniform(20, 900), 2),
+        'pilot': pilot,
+        'club': {'id': rng.randint(1, 3000), 'name': rng.choice(clubs)},
+        'takeoff': {'id': rng.randint(1, 5000), 'name': rng.choice(takeoffs)},
+        'aircraft': airplane,
+        'pilot_comment': rng.choice([None, 'Nice thermals, cloudbase 1800m.', 'Outlanding near the river.']),
+        'checked': True,
+    }
+    if rng.random() < 0.2:
+        flight['copilot'] = {'id': rng.randint(1000, 99999), 'firstName': rng.choice(first_names), 'surName': rng.choice(surnames)}
+        flight['co_pilot_name'] = f"{flight['copilot']['firstName']} {flight['copilot']['surName']}"
+    return flight
+
+
+def bench(serializer, value, rounds=50):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        data = serializer.dumps(value)
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        loaded = serializer.loads(data)
+    t2 = time.perf_counter()
+    assert loaded == value, f'{serializer.__class__.__name__} did not round trip'
+    return len(data), (t1 - t0) / rounds * 1000, (t2 - t1) / rounds * 1000
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = random.Random(42)
+    fixtures = {
+        f'flight list ({count})': ([make_flight(rng, 9000000 + i) for i in range(count)], rng.randint(2000, 2020)),
+        'flightbook response': {'result': [make_flight(rng, 9100000 + i) for i in range(count // 4)]},
+        'flight ref': 1234567890,
+        'rows without fields': [{}, {}, {'id': 1}, {}],
+        'empty rows': [{}, {}],
+    }
+    serializers = [Lz4PickleSerializer(), ColumnarMsgpackSerializer()]
+
+    print(f"{'fixture':<24}{'serializer':<28}{'bytes':>10}{'encode ms':>12}{'decode ms':>12}")
+    for name, value in fixtures.items():
+        for serializer in serializers:
+            size, encode_ms, decode_ms = bench(serializer, value)
+            print(f'{name:<24}{serializer.__class__.__name__:<28}{size:>10}{encode_ms:>12.3f}{decode_ms:>12.3f}')
@@ -1,32 +1,53 @@
 import asyncio
 import logging
+import math
 import time
 from collections import defaultdict, deque
 
 
-class EWMA:
-    def __init__(self, alpha=0.2):
-        self.alpha = alpha; self.value = None
-    def update(self, x):
-        self.value = x if self.value is None else self.alpha*x + (1-self.alpha)*self.value
-        return self.value
+class DecayingHistogram:
+    """Streaming quantiles of durations: log-spaced buckets with exponentially decaying weights.
 
-class RollingQuantile:
-    def __init__(self, maxlen=500):
-        self.samples = deque(maxlen=maxlen)
+    Buckets grow by `growth` (~5% relative error), so quantile() walks a fixed number of buckets whatever
+    the sample count. Samples lose half their weight every `half_life` seconds (forward decay,
+    old samples are never touched).
+    """
+    def __init__(self, half_life=300.0, min_value=0.001, max_value=3600.0, growth=1.05, clock=time.monotonic):
+        self.min_value = min_value; self.log_growth = math.log(growth)
+        self.counts = [0.0] * (int(math.ceil(math.log(max_value/min_value)/self.log_growth)) + 1)
+        self.total = 0.0; self.sum = 0.0
+        self.rate = math.log(2)/half_life
+        self.clock = clock; self.landmark = clock()
+    def _weight(self):
+        now = self.clock()
+        exponent = self.rate*(now-self.landmark)
+        if exponent > 50:
+            # Rescale to the current time before weights overflow, also after days without samples
+            scale = math.exp(-exponent)
+            self.counts = [c*scale for c in self.counts]; self.total *= scale; self.sum *= scale
+            self.landmark = now; exponent = 0.0
+        return math.exp(exponent)
     def update(self, x):
-        self.samples.append(x)
+        w = self._weight()
+        idx = 0 if x <= self.min_value else min(len(self.counts)-1, int(math.log(x/self.min_value)/self.log_growth))
+        self.counts[idx] += w; self.total += w; self.sum += w*x
+    def mean(self):
+        return self.sum/self.total if self.total else None
     def quantile(self, q):
-        if not self.samples: return None
-        s = sorted(self.samples)
-        idx = min(len(s)-1, max(0, int(q*(len(s)-1))))
-        return s[idx]
+        if not self.total: return None
+        target = q*self.total; seen = 0.0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                # geometric middle of the bucket
+                return self.min_value*math.exp((idx+0.5)*self.log_growth)
+        return self.min_value*math.exp((len(self.counts)-0.5)*self.log_growth)
 
 class AdaptiveCap:
     def __init__(self, floor=4, ceiling=64):
         self.cap = floor; self.floor=floor; self.ceiling=ceiling
         self.win = deque(maxlen=200)
-    def record(self, ok: bool):
+    def record(self, ok: bool, rtt=None, inflight=None):
         self.win.append(ok)
         if len(self.win) < 20: return
         err = 1 - (sum(self.win)/len(self.win))
@@ -35,125 +56,300 @@ class AdaptiveCap:
         else:
             self.cap = min(self.ceiling, self.cap+1)
 
-class DRRScheduler:
-    def __init__(self, adaptive: AdaptiveCap):
-        self.q = defaultdict(deque)       # user_id -> deque of items
-        self.weights = defaultdict(lambda: 1)
-        self.deficit = defaultdict(int)
-        self.quantum = 1                  # 1 request per turn
-        self.active_users = deque()
-        self.inflight = 0
-        self.adaptive = adaptive
-        # service metrics
-        self.s_mean = EWMA(alpha=0.2)
-        self.qstats = RollingQuantile()
-        self.lock = asyncio.Lock()
+class GradientCap:
+    """Concurrency cap from the gradient of the recent service time against a measured baseline (Vegas/Gradient style).
 
-    def enqueue_batch(self, user_id, items, weight=1):
-        self.weights[user_id] = weight
-        was_empty = not self.q[user_id]
-        for it in items:
-            self.q[user_id].append(it)
-        if was_empty and self.q[user_id]:
-            self.active_users.append(user_id)
+    The baseline is the lowest recent service time, when the upstream starts queueing the service time rises
+    above it and the cap shrinks with the ratio. Within `tolerance` of the baseline the cap grows by about
+    sqrt(cap) per round of cap requests, as long as the recent error rate is below `error_threshold`. Every `probe_interval` samples the cap is halved for a moment to
+    measure the baseline again, as an upstream can become slower or faster for good. Errors above the
+    threshold back off multiplicatively. Same interface as AdaptiveCap, so each lane picks its controller.
+    """
+    def __init__(self, floor=4, ceiling=64, tolerance=1.5, smoothing=0.2, short_window=10, probe_interval=1000,
+                 backoff=0.9, error_window=50, error_threshold=0.02):
+        self.floor = floor; self.ceiling = ceiling
+        self.limit = float(floor); self.cap = floor
+        self.tolerance = tolerance; self.smoothing = smoothing; self.backoff = backoff
+        self.short_window = short_window; self.short_alpha = 2/(short_window+1)
+        self.probe_interval = probe_interval
+        self.error_alpha = 2/(error_window+1); self.error_threshold = error_threshold; self.error_rate = 0.0
+        self.short_rtt = None; self.baseline = None
+        self.samples = 0; self.probing = 0; self.probed_limit = None
+    def _set(self, limit):
+        self.limit = max(self.floor, min(self.ceiling, limit))
+        self.cap = int(self.limit)
+    def record(self, ok: bool, rtt=None, inflight=None):
+        self.error_rate += self.error_alpha*((not ok)-self.error_rate)
+        if not ok:
+            if self.error_rate > self.error_threshold:
+                self._set(self.limit*self.backoff)
+            return
+        if rtt is None: return
+        rtt = max(rtt, 1e-6)  # Cache hits can take no measurable time, the gradient divides by it
+        if self.short_rtt is None:
+            self.short_rtt = self.baseline = rtt
+            return
+        self.short_rtt += self.short_alpha*(rtt-self.short_rtt)
+        self.samples += 1
+        if self.probing:
+            self.probing -= 1
+            if not self.probing:
+                self.baseline = self.short_rtt  # Measured at half the cap
+                self._set(self.probed_limit)  # The gradient cuts it again if the upstream is queueing
+            return
+        if self.samples % self.probe_interval == 0:
+            # Drain the requests started at the old cap, then measure for a short window
+            self.probing = self.cap + self.short_window
+            self.probed_limit = self.limit
+            self._set(self.limit/2)
+            return
+        self.baseline = min(self.baseline, self.short_rtt)
+        if inflight is not None and inflight < self.limit/2:
+            return  # Not using the cap, no evidence it can grow
+        gradient = max(0.5, min(1.0, self.tolerance*self.baseline/self.short_rtt))
+        growth = math.sqrt(self.limit)/self.limit if self.error_rate <= self.error_threshold else 0
+        self._set(self.limit + self.smoothing*(gradient-1)*self.limit + growth)
 
-    def enqueue_one(self, user_id, coro, weight=1):
-        loop = asyncio.get_event_loop()
-        future = loop.create_future()
+class FairQueue:
+    """Deficit round robin between users over the queued items of one priority class.
 
-        async def wrapper():
-            try:
-                result = await coro
-                future.set_result(result)
-            except Exception as e:
-                future.set_exception(e)
+    Only users with queued items have state, it is dropped as soon as their queue runs empty.
+    """
+    def __init__(self, quantum=1):
+        self.q = {}                       # user_id -> deque of items
+        self.weights = {}
+        self.deficit = {}
+        self.quantum = quantum            # 1 request per turn
+        self.active_users = deque()
+        # running totals, so metrics and ETA never scan all users
+        self.queued = 0
+        self.active_weight = 0
 
-        self.weights[user_id] = weight
-        was_empty = not self.q[user_id]
-        self.q[user_id].append(wrapper())
-        if was_empty and self.q[user_id]:
+    def append(self, user_id, items, weight):
+        if user_id not in self.q:
+            self.q[user_id] = deque(); self.deficit[user_id] = 0; self.weights[user_id] = 0
             self.active_users.append(user_id)
-        return future
+        self.active_weight += weight - self.weights[user_id]
+        self.weights[user_id] = weight
+        self.q[user_id].extend(items)
+        self.queued += len(items)
+
+    def _evict(self, uid):
+        # Queue ran empty: forget the user, a returning user starts with a fresh deficit
+        self.active_weight -= self.weights.pop(uid)
+        del self.q[uid], self.deficit[uid]
 
-    async def _pop_next(self):
-        # DRR round-robin over active users
-        if not self.active_users: return None, None
+    def pop(self):
+        # DRR round-robin over active users, every user in active_users has queued items
         for _ in range(len(self.active_users)):
             uid = self.active_users[0]
-            if not self.q[uid]:
-                self.active_users.popleft()
-                continue
             self.deficit[uid] += self.quantum * self.weights[uid]
             if self.deficit[uid] <= 0:
                 self.active_users.rotate(-1)
                 continue
             item = self.q[uid].popleft()
+            self.queued -= 1
             self.deficit[uid] -= 1
             # keep uid active if more items remain
             if self.q[uid]:
                 self.active_users.rotate(-1)
             else:
                 self.active_users.popleft()
+                self._evict(uid)
             return uid, item
         return None, None
 
+    def share(self, user_id):
+        # approximate: share = weight / sum(weights of active users)
+        return self.weights.get(user_id, 0)/self.active_weight if self.active_weight else 1.0
+
+
+class DRRScheduler:
+    """Per-user DRR within priority classes, dispatching up to the adaptive cap.
+
+    Classes have strict precedence in the order of `priorities`, so an interactive request never waits behind
+    queued bulk work. A lower class that was not served for `aging_seconds` gets the next slot, so bulk work
+    still progresses while interactive traffic keeps coming.
+    """
+    def __init__(self, adaptive, priorities=('interactive', 'bulk'), aging_seconds=2.0, clock=time.monotonic):
+        self.classes = {priority: FairQueue() for priority in priorities}
+        self.aging_seconds = aging_seconds
+        self.clock = clock
+        self.served_at = {priority: clock() for priority in priorities}
+        self.inflight = 0
+        self.adaptive = adaptive
+        # service metrics, overall and per operation (fetch_flights, upload, ...)
+        self.qstats = DecayingHistogram(clock=clock)
+        self.op_stats = defaultdict(lambda: DecayingHistogram(clock=clock))
+        self.tasks = set()
+        self.wakeup = asyncio.Event()  # Set when work is enqueued or capacity frees up
+
+    @property
+    def queued(self):
+        return sum(fair_queue.queued for fair_queue in self.classes.values())
+
+    def _append(self, user_id, items, weight, priority):
+        fair_queue = self.classes[priority]
+        if not fair_queue.queued:
+            # Age from the moment the class has work, not from when it was last served
+            self.served_at[priority] = self.clock()
+        fair_queue.append(user_id, items, weight)
+        self.wakeup.set()
+
+    def enqueue_batch(self, user_id, items, weight=1, op='default', priority='bulk'):
+        items = [(op, it) for it in items]
+        if items:
+            self._append(user_id, items, weight, priority)
+
+    def enqueue_one(self, user_id, coro, weight=1, op='default', priority='bulk'):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        async def wrapper():
+            if future.cancelled():
+                coro.close()  # Nobody waits for the result anymore, skip the upstream call
+                return
+            # Cancelling the caller cancels the upstream call too, so its slot is free for the next item
+            running = asyncio.current_task()
+            future.add_done_callback(lambda f: running.cancel() if f.cancelled() else None)
+            try:
+                result = await coro
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                raise  # Count as error in the scheduler metrics
+
+        self._append(user_id, [(op, wrapper())], weight, priority)
+        return future
+
+    def _pop_next(self):
+        waiting = [priority for priority, fair_queue in self.classes.items() if fair_queue.queued]
+        if not waiting:
+            return None, None
+        now = self.clock()
+        priority = waiting[0]
+        for lower in waiting[1:]:
+            if now - self.served_at[lower] > self.aging_seconds:
+                priority = lower  # Starving, let one item through
+                break
+        self.served_at[priority] = now
+        return self.classes[priority].pop()
+
     async def run(self):
-        # one background task; schedule up to adaptive.cap inflight
+        # one background task dispatching each item as its own task, up to adaptive.cap inflight
         while True:
-            async with self.lock:
-                can_launch = max(0, self.adaptive.cap - self.inflight)
-            if can_launch <= 0:
-                await asyncio.sleep(0.01); continue
-            uid, item = await self._pop_next()
+            uid = None
+            if self.inflight < self.adaptive.cap:
+                uid, item = self._pop_next()
             if uid is None:
-                await asyncio.sleep(0.01); continue
-            async with self.lock:
-                self.inflight += 1
-            started = time.perf_counter()
-            ok = True
-            try:
-                await item
-            except Exception as e:
-                ok = False
-                logging.error(f"Error in drr scheduled task for user {uid}: {e}")
-            finally:
-                dt = time.perf_counter() - started
-                self.s_mean.update(dt)
+                # Sleep until enqueue or a finished task signals work or capacity
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            self.inflight += 1
+            task = asyncio.ensure_future(self._execute(uid, item))
+            self.tasks.add(task)  # Keep a reference, the event loop only holds weak ones
+            task.add_done_callback(self.tasks.discard)
+
+    async def _execute(self, uid, item):
+        op, coro = item
+        started = self.clock()
+        ok = True
+        try:
+            await coro
+        except asyncio.CancelledError:
+            ok = None  # Cancelled by its caller, says nothing about the upstream
+        except Exception as e:
+            ok = False
+            logging.error(f"Error in drr scheduled task for user {uid}: {e}")
+        finally:
+            # Release the slot first, the lane must keep going whatever happens to the metrics
+            dt = self.clock() - started
+            inflight = self.inflight
+            self.inflight -= 1
+            self.wakeup.set()
+            if ok is not None:
                 self.qstats.update(dt)
-                self.adaptive.record(ok)
-                async with self.lock:
-                    self.inflight -= 1
+                self.op_stats[op].update(dt)
+                self.adaptive.record(ok, dt, inflight)
 
     # ---- metrics for UI ----
     def global_load(self):
         return self.inflight, self.adaptive.cap
     def active_user_count(self):
-        return sum(1 for u in self.q if self.q[u]) + (1 if self.inflight else 0)
-    def service_times(self):
-        return self.s_mean.value, self.qstats.quantile(0.5), self.qstats.quantile(0.9)
+        # A user with work in several classes counts once per class
+        return sum(len(fair_queue.q) for fair_queue in self.classes.values()) + (1 if self.inflight else 0)
+    def service_times(self, op=None):
+        stats = self.qstats if op is None else self.op_stats[op]
+        return stats.mean(), stats.quantile(0.5), stats.quantile(0.9), stats.quantile(0.99)
+    def service_times_by_op(self):
+        return {op: self.service_times(op) for op in self.op_stats}
 
-    def user_effective_rate(self, user_id):
-        # approximate: share = weight / sum(weights of active users)
-        active = [u for u in self.q if self.q[u]]
-        if not active: return (self.adaptive.cap, 1.0)
-        sumw = sum(self.weights[u] for u in active)
-        share = self.weights[user_id]/sumw if sumw else 1.0
+    def user_effective_rate(self, user_id, priority='bulk'):
+        fair_queue = self.classes[priority]
+        if not fair_queue.q: return (self.adaptive.cap, 1.0)
+        share = fair_queue.share(user_id)
         return (self.adaptive.cap * share, share)
 
-    def eta_seconds(self, user_id, N):
-        s_mean, s50, s90 = self.service_times()
+    def eta_seconds(self, user_id, N, op=None, priority='bulk'):
+        s_mean, s50, s90, _ = self.service_times(op)
         s_mean = s_mean or 1.0
         s50 = s50 or s_mean
         s90 = s90 or s_mean*1.5
-        r_user, _ = self.user_effective_rate(user_id)  # requests/sec
+        r_user, _ = self.user_effective_rate(user_id, priority)  # requests/sec
         r_user = max(0.001, r_user)
         eta50 = N / r_user * (s50 / s_mean)
         eta90 = N / r_user * (s90 / s_mean)
-        # plus wait-to-start if there is work ahead of you
-        work_ahead = sum(len(self.q[u]) for u in self.q if u != user_id)
+        # plus wait-to-start if there is work ahead of you: your class and the ones above it
+        work_ahead = 0
+        for p, fair_queue in self.classes.items():
+            work_ahead += fair_queue.queued
+            if p == priority:
+                work_ahead -= len(fair_queue.q.get(user_id, ()))
+                break
         global_rate = max(0.001, self.adaptive.cap)   # items per service-time unit
         wait_start = work_ahead / global_rate * (s50)  # crude but robust
         return (wait_start + eta50, wait_start + eta90)
 
+    def snapshot(self):
+        s_mean, s50, s90, s99 = self.service_times()
+        return {
+            "inflight": self.inflight, "cap": self.adaptive.cap, "active_users": self.active_user_count(),
+            "queued": {priority: fair_queue.queued for priority, fair_queue in self.classes.items()},
+            "service_time_sec": {"mean": s_mean, "p50": s50, "p90": s90, "p99": s99},
+        }
+
+
+class SchedulerLanes:
+    """One DRR scheduler per upstream resource, each with its own concurrency controller and metrics.
+
+    Only single upstream calls are submitted, so a slow upstream fills its own lane and not the others.
+    """
+    def __init__(self, lanes):
+        self.lanes = lanes  # name -> DRRScheduler
+
+    def __getitem__(self, name):
+        return self.lanes[name]
+
+    async def submit(self, lane, user_id, coro, weight=1, op=None, priority='bulk'):
+        """Queue coro in a lane with DRR fairness between users, returns its result once executed."""
+        return await self.lanes[lane].enqueue_one(user_id, coro, weight=weight, op=op or lane, priority=priority)
+
+    async def run(self):
+        await asyncio.gather(*(scheduler.run() for scheduler in self.lanes.values()))
+
+    def snapshot(self):
+        return {name: scheduler.snapshot() for name, scheduler in self.lanes.items()}
+
 
+# Admission of whole uploads, the upstream calls of each upload go through the lanes below
 drr_scheduler = DRRScheduler(AdaptiveCap(floor=4, ceiling=32))
+lanes = SchedulerLanes({
+    'olc_json': DRRScheduler(GradientCap(floor=4, ceiling=32)),
+    'olc_html': DRRScheduler(GradientCap(floor=4, ceiling=16)),
+    'olc_igc': DRRScheduler(GradientCap(floor=4, ceiling=16)),
+    'weglide_upload': DRRScheduler(GradientCap(floor=2, ceiling=2)),  # Never more than 2 uploads to WeGlide at once
+    'weglide_meta': DRRScheduler(GradientCap(floor=2, ceiling=8)),
+})
@@ -0,0 +1,166 @@
+import math
+import re
+from array import array
+from datetime import date
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# B-record: time HHMMSS, latitude DDMMmmm N/S, longitude DDDMMmmm E/W, fix validity, pressure and GNSS altitude
+b_record = re.compile(rb'^B\d{6}\d{7}[NS]\d{8}[EW][AV](?:-\d{4}|\d{5})(?:-\d{4}|\d{5})', re.MULTILINE)
+b_record_length = 35
+hfdte = re.compile(rb'^HFDTE(?:DATE:)?(\d{2})(\d{2})(\d{2})', re.MULTILINE)
+earth_radius_km = 6371.0
+moving_speed = 10.0  # m/s, faster between two fixes is flying (or towing, or driving to the launch point)
+landed_gap = 120  # Seconds not moving that end a flight
+min_flight_duration = 60  # Seconds moving to count as a flight, shorter moves are ground handling
+distance_tolerance = 1.05  # Scored OLC distance is at most the length of the track, with some rounding margin
+
+
+class IgcFileError(Exception):
+    pass
+
+
+class IgcTrack:
+    """Fixes of an IGC file as columns, NumPy arrays when available, otherwise arrays from the standard library.
+
+    Only fixes with validity A are kept, V fixes have no GPS position and would add jumps to the track.
+    time is in seconds since midnight UTC of the first fix and keeps counting after midnight,
+    lat and lon are in degrees, the altitudes in meters.
+    """
+    def __init__(self, day, time, lat, lon, pressure_alt, gps_alt, lines, records):
+        self.date = day
+        self.time = time; self.lat = lat; self.lon = lon
+        self.pressure_alt = pressure_alt; self.gps_alt = gps_alt
+        self.malformed = lines - records  # B-lines that could not be read
+        self.invalid = records - len(time)  # V fixes
+
+    def __len__(self):
+        return len(self.time)
+
+
+def _header_date(data):
+    match = hfdte.search(data)
+    if not match:
+        return None
+    day, month, year = (int(group) for group in match.groups())
+    try:
+        return date(2000 + year if year < 80 else 1900 + year, month, day)
+    except ValueError:
+        return None
+
+
+def _columns_numpy(records):
+    fixes = np.frombuffer(b''.join(records), dtype=np.uint8).reshape(-1, b_record_length)
+    fixes = fixes[fixes[:, 24] == ord('A')]
+    digits = fixes.astype(np.int64) - ord('0')
+
+    def number(start, end):
+        return digits[:, start:end] @ 10 ** np.arange(end - start - 1, -1, -1)
+
+    def altitude(start):
+        negative = fixes[:, start] == ord('-')
+        return np.where(negative, -number(start + 1, start + 5), number(start, start + 5))
+
+    time = number(1, 3) * 3600 + number(3, 5) * 60 + number(5, 7)
+    time += np.concatenate(([0], np.cumsum(np.diff(time) < -43200))) * 86400  # Past midnight
+    lat = (number(7, 9) + number(9, 14) / 60000) * np.where(fixes[:, 14] == ord('S'), -1, 1)
+    lon = (number(15, 18) + number(18, 23) / 60000) * np.where(fixes[:, 23] == ord('W'), -1, 1)
+    return time, lat, lon, altitude(25), altitude(30)
+
+
+def _columns_python(records):
+    time, lat, lon, pressure_alt, gps_alt = array('q'), array('d'), array('d'), array('l'), array('l')
+    day = 0
+    for r in records:
+        if r[24] != 65:  # V
+            continue
+        seconds = int(r[1:3]) * 3600 + int(r[3:5]) * 60 + int(r[5:7]) + day
+        if time and seconds - time[-1] < -43200:
+            day += 86400
+            seconds += 86400
+        time.append(seconds)
+        lat.append((int(r[7:9]) + int(r[9:14]) / 60000) * (-1 if r[14] == 83 else 1))  # S
+        lon.append((int(r[15:18]) + int(r[18:23]) / 60000) * (-1 if r[23] == 87 else 1))  # W
+        pressure_alt.append(int(r[25:30]))
+        gps_alt.append(int(r[30:35]))
+    return time, lat, lon, pressure_alt, gps_alt
+
+
+def parse_igc(data, use_numpy=True):
+    """Read the B-records of an IGC file (str or bytes) into an IgcTrack."""
+    if isinstance(data, str):
+        data = data.encode('latin-1', errors='replace')
+    records = b_record.findall(data)
+    columns = _columns_numpy if use_numpy and np is not None else _columns_python
+    return IgcTrack(_header_date(data), *columns(records), lines=data.count(b'\nB') + data.startswith(b'B'), records=len(records))
+
+
+def _flights_numpy(track):
+    lat, lon, time = np.radians(track.lat), np.radians(track.lon), np.asarray(track.time)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    legs = 2 * earth_radius_km * np.arcsin(np.sqrt(np.minimum(a, 1)))
+    durations = np.diff(time)
+    moving = (durations > 0) & (legs * 1000 > moving_speed * durations)
+    starts, ends = time[:-1][moving], time[1:][moving]
+    if not len(starts):
+        return [], float(legs.sum())
+    split = np.flatnonzero(starts[1:] - ends[:-1] > landed_gap)
+    segments = zip(starts[np.concatenate(([0], split + 1))].tolist(), ends[np.concatenate((split, [len(ends) - 1]))].tolist())
+    return list(segments), float(legs.sum())
+
+
+def _flights_python(track):
+    segments = []
+    length = 0.0
+    for i in range(1, len(track)):
+        lat1, lat2 = math.radians(track.lat[i - 1]), math.radians(track.lat[i])
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(track.lon[i] - track.lon[i - 1]) / 2) ** 2
+        leg = 2 * earth_radius_km * math.asin(math.sqrt(min(a, 1)))
+        length += leg
+        start, end = track.time[i - 1], track.time[i]
+        if end <= start or leg * 1000 <= moving_speed * (end - start):
+            continue
+        if segments and start - segments[-1][1] <= landed_gap:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+    return segments, length
+
+
+def flights(track):
+    """Takeoff and landing time of every flight in the track, and the length of the track in km."""
+    segments, length_km = (_flights_numpy if np is not None and isinstance(track.time, np.ndarray) else _flights_python)(track)
+    return [(takeoff, landing) for takeoff, landing in segments if landing - takeoff >= min_flight_duration], length_km
+
+
+def check_igc(data, flight):
+    """Validate an IGC file against the OLC flight before it is uploaded.
+
+    Raises IgcFileError for files that are not worth uploading, returns a summary with warnings about the others.
+    """
+    track = parse_igc(data)
+    if not len(track):
+        raise IgcFileError('No valid fixes in IGC file')
+    takeoffs, length_km = flights(track)
+    if not takeoffs:
+        raise IgcFileError('No flight found in IGC file')
+    warnings = []
+    if track.malformed:
+        warnings.append(f'{track.malformed} malformed fixes')
+    if track.invalid:
+        warnings.append(f'{track.invalid} fixes without GPS position')
+    if len(takeoffs) > 1:
+        warnings.append(f'{len(takeoffs)} takeoffs')
+    olc_date = flight.get('date')
+    if not track.date:
+        warnings.append('No date in IGC header')
+    elif olc_date and abs((track.date - date.fromisoformat(olc_date)).days) > 1:
+        # One day apart happens for flights far from UTC
+        raise IgcFileError(f'IGC file is of {track.date}, the OLC flight of {olc_date}')
+    olc_distance = flight.get('distance')
+    if olc_distance and float(olc_distance) > length_km * distance_tolerance + 1:
+        raise IgcFileError(f'IGC track of {length_km:.0f} km is shorter than the OLC distance of {float(olc_distance):.0f} km')
+    return {'fixes': len(track), 'takeoffs': len(takeoffs), 'length_km': round(length_km, 1), 'warnings': warnings}
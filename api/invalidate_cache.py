@@ -0,0 +1,16 @@
+"""Invalidate cached OLC data after deploying a parser fix.
+
+Usage: python invalidate_cache.py <namespace> [user_id]
+Namespaces are defined in misc.cache_policies, e.g. olc_flights or olc_request.
+"""
+import asyncio
+import sys
+
+import app  # noqa: F401, sets the aiocache config
+from misc import cache_policies, invalidate_cache
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in cache_policies:
+        sys.exit(f'Usage: python invalidate_cache.py <{"|".join(cache_policies)}> [user_id]')
+    scope = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    asyncio.run(invalidate_cache(sys.argv[1], scope))
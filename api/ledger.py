@@ -0,0 +1,26 @@
+from app import redis_client
+
+# OLC flights that reached WeGlide, one hash per OLC pilot of OLC flight id -> WeGlide flight id.
+# Never expires, unlike the upload statuses, so re-running a migration does not transfer the same IGC files again.
+# Small hashes of integers are stored compactly by Redis, a pilot's archive is a few hundred flights at most.
+ledger_prefix = 'ledger:'
+
+
+def _ledger_key(olc_user_id):
+    return f'{ledger_prefix}{olc_user_id}'
+
+
+async def record_upload(olc_user_id, olc_flight_id, weglide_flight_id):
+    await redis_client.hset(_ledger_key(olc_user_id), int(olc_flight_id), int(weglide_flight_id))
+
+
+async def get_uploaded(olc_user_id, olc_flight_ids):
+    """WeGlide flight id of each of the given OLC flights that is in the ledger."""
+    olc_flight_ids = [int(flight_id) for flight_id in olc_flight_ids]
+    if not olc_flight_ids:
+        return {}
+    weglide_flight_ids = await redis_client.hmget(_ledger_key(olc_user_id), olc_flight_ids)
+    return {
+        flight_id: int(weglide_flight_id)
+        for flight_id, weglide_flight_id in zip(olc_flight_ids, weglide_flight_ids) if weglide_flight_id is not None
+    }
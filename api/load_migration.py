@@ -0,0 +1,221 @@
+"""Run whole migrations through the real Tornado app against the local OLC and WeGlide stand-ins.
+
+Starts the stand-in servers and the API (app.py, needs Redis) pointed at them, then every synthetic user fetches
+their flights, submits them all for upload and polls the job until it is finished, like the frontend does.
+Reports requests/s, end-to-end latency per migration and the CPU and memory used by the API process.
+The ledger of uploaded flights of the synthetic pilots is cleared first, unless --resume submits only what is missing.
+
+Usage: python load_migration.py [--users 20] [--ramp 10] [--start-year 2020] [--app http://localhost:9001] [--resume]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+from cryptography.fernet import Fernet
+import redis.asyncio
+
+import standin_servers
+
+api_port = 9001
+poll_interval = 1.0
+
+
+def percentiles(values):
+    if not values:
+        return (0.0, 0.0, 0.0)
+    values = sorted(values)
+    return tuple(values[min(len(values) - 1, int(len(values) * q))] for q in (0.5, 0.9, 1.0))
+
+
+class ProcessSampler:
+    """CPU seconds and resident memory of a process, read from /proc."""
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.cpu_start = self.cpu_seconds()
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    async def run(self, interval=0.5):
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss())
+            await asyncio.sleep(interval)
+
+
+def olc_user_id(user):
+    return 1000 + user
+
+
+async def clear_ledgers(users):
+    """Forget which flights of the synthetic pilots reached WeGlide, so every run uploads all of them."""
+    client = redis.asyncio.Redis(host=os.environ.get('REDIS_HOST', 'localhost'), port=os.environ.get('REDIS_PORT', '6379'))
+    try:
+        await client.delete(*[f'ledger:{olc_user_id(user)}' for user in range(users)])
+    finally:
+        await client.aclose()
+
+
+class Driver:
+    def __init__(self, app_url, start_year, timeout, resume=False):
+        self.app_url = app_url.rstrip('/')
+        self.start_year = start_year
+        self.timeout = timeout
+        self.resume = resume
+        self.requests = 0
+        self.migrations = []  # (fetch seconds, upload seconds, done, error)
+        self.failures = []
+
+    async def _request(self, session, method, path, **kwargs):
+        self.requests += 1
+        async with session.request(method, f'{self.app_url}/{path}', **kwargs) as response:
+            if response.status != 200:
+                raise RuntimeError(f'{method} /{path}: {response.status} {await response.text()}')
+            return await response.json(content_type=None)
+
+    async def migrate(self, session, user):
+        """One pilot moving their archive: list the flights, upload all of them, wait for the job."""
+        t0 = time.monotonic()
+        flights = await self._request(session, 'GET', 'fetch_flights', params={'user_id': olc_user_id(user), 'start_year': self.start_year})
+        t1 = time.monotonic()
+        body = {
+            'user_id': olc_user_id(user),
+            'start_year': self.start_year,
+            'weglide_user_id': 5000 + user,
+            'weglide_dateofbirth': '1980-01-01',
+            'olc_user': f'loadtest{user}',
+            'olc_password': 'secret',
+            'flights': [{
+                'id': flight['id'],
+                'date': flight['date'],
+                'pilot': flight['pilot']['firstName'] + ' ' + flight['pilot']['surName'],
+                'co_pilot': flight.get('co_pilot_name'),
+                'airplane_weglide': flight['airplane_weglide'],
+                'registration': flight.get('registration'),
+                'competition_id': flight.get('competition_id'),
+                'distance': flight['distanceInKm'],
+                'pilot_comment': flight.get('pilot_comment'),
+            } for flight in flights],
+        }
+        if self.resume:
+            # The API lists the flights itself and uploads the ones not in the ledger
+            body.update(resume=True, flights=[])
+        submitted = await self._request(session, 'POST', 'upload_flights', json=body, headers={'Idempotency-Key': f'loadtest-{user}-{t0}'})
+        while True:
+            await asyncio.sleep(poll_interval)
+            job = await self._request(session, 'GET', 'upload_job', params={'job_id': submitted['job_id']})
+            if not job['processing']:
+                break
+            if time.monotonic() - t0 > self.timeout:
+                raise RuntimeError(f"job {submitted['job_id']} still has {job['processing']} flights processing")
+        self.migrations.append((t1 - t0, time.monotonic() - t1, job['done'], job['error']))
+
+    async def run_user(self, session, user, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self.migrate(session, user)
+        except Exception as e:
+            self.failures.append(f'user {user}: {e}')
+
+
+async def wait_for_app(app_url, timeout=30):
+    async with aiohttp.ClientSession() as session:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f'{app_url}/find_gliders', params={'name': 'LS 8'}) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f'API at {app_url} did not come up')
+
+
+async def standin_stats(session):
+    stats = {}
+    for name, url in (('olc', f'http://localhost:{standin_servers.olc_port}/olc-3.0/_stats'),
+                      ('weglide', f'http://localhost:{standin_servers.weglide_port}/v1/_stats')):
+        async with session.get(url) as response:
+            stats[name] = await response.json()
+    return stats
+
+
+async def main(args):
+    runners = await standin_servers.start(*standin_servers.behaviours(args))
+    app = None
+    app_url = args.app
+    if not app_url:
+        # The API under test in its own process, so its resource use is measured on its own
+        env = dict(os.environ,
+                   OLC_BASE_URL=f'http://localhost:{standin_servers.olc_port}/olc-3.0/',
+                   WEGLIDE_BASE_URL=f'http://localhost:{standin_servers.weglide_port}/v1/',
+                   UPLOAD_CREDENTIALS_KEY=os.environ.get('UPLOAD_CREDENTIALS_KEY') or Fernet.generate_key().decode())
+        app = subprocess.Popen([sys.executable, 'app.py'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        app_url = f'http://localhost:{api_port}'
+    try:
+        await wait_for_app(app_url)
+        if not args.resume:
+            await clear_ledgers(args.users)
+        sampler = ProcessSampler(app.pid) if app else None
+        sampling = asyncio.ensure_future(sampler.run()) if sampler else None
+        driver = Driver(app_url, args.start_year, args.timeout, args.resume)
+        t0 = time.monotonic()
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120)) as session:
+            await asyncio.gather(*[
+                driver.run_user(session, user, args.ramp * user / max(1, args.users - 1)) for user in range(args.users)
+            ])
+            elapsed = time.monotonic() - t0
+            stats = await standin_stats(session)
+        if sampling:
+            sampling.cancel()
+            cpu = sampler.cpu_seconds() - sampler.cpu_start
+    finally:
+        if app:
+            app.terminate()
+            app.wait()
+        for runner in runners:
+            await runner.cleanup()
+
+    flights_done = sum(m[2] for m in driver.migrations)
+    flights_error = sum(m[3] for m in driver.migrations)
+    print(f'{len(driver.migrations)}/{args.users} migrations in {elapsed:.1f}s, {flights_done} flights uploaded, {flights_error} failed')
+    for failure in driver.failures:
+        print(f'  failed: {failure}')
+    print(f'API          {driver.requests / elapsed:>8.1f} req/s ({driver.requests} requests)')
+    for name, s in stats.items():
+        statuses = ' '.join(f'{status}:{n}' for status, n in sorted(s['statuses'].items()))
+        print(f'{name:<12} {s["requests"] / elapsed:>8.1f} req/s ({s["requests"]} requests, {statuses})')
+    for name, column in (('fetch', 0), ('upload', 1)):
+        p50, p90, worst = percentiles([m[column] for m in driver.migrations])
+        print(f'{name:<12} p50 {p50:>7.1f}s  p90 {p90:>7.1f}s  max {worst:>7.1f}s')
+    p50, p90, worst = percentiles([m[0] + m[1] for m in driver.migrations])
+    print(f'{"end-to-end":<12} p50 {p50:>7.1f}s  p90 {p90:>7.1f}s  max {worst:>7.1f}s')
+    if sampler:
+        print(f'API process  {cpu:.1f} CPU seconds ({cpu / elapsed:.0%} of a core), peak RSS {sampler.peak_rss / 1024 ** 2:.0f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=20, help='Pilots migrating their archive')
+    parser.add_argument('--ramp', type=float, default=10.0, help='Seconds over which the users arrive')
+    parser.add_argument('--start-year', type=int, default=2023,
+                        help=f'First season, {standin_servers.flights_per_season} flights per season')
+    parser.add_argument('--timeout', type=float, default=900.0, help='Seconds a migration may take')
+    parser.add_argument('--app', help='URL of an API that is already running against the stand-ins, instead of starting app.py')
+    parser.add_argument('--resume', action='store_true', help='Keep the ledger and submit with resume, uploads only what is missing')
+    standin_servers.behaviour_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -1,16 +1,20 @@
 import asyncio
+import hashlib
+import json
 import logging
-import random
 import re
 import sys
 import time
 
 import lz4.frame
+import msgpack
 import sentry_sdk
+from aiocache import caches, cached
 from aiocache.plugins import BasePlugin
-from aiocache.serializers import PickleSerializer
+from aiocache.serializers import BaseSerializer, PickleSerializer
 
 from app import redis_client
+from upload_jobs import set_job_flight_status
 
 
 def make_link_if_url(text):
@@ -93,18 +97,176 @@ class MetricSemaphore(asyncio.Semaphore):
             return super().release()
 
 
-def cache_key_builder(func, *args, **kwargs):
-    """Create a cache key, ignoring 'self' and any argument starting with '_'.
+def stored_size(data):
+    """Bytes of a serialized cache value, memory caches store objects as-is."""
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    return sys.getsizeof(data)
+
+
+class CacheTelemetry:
+    """Per cache namespace counters, latency and stored bytes, aggregated in-process."""
+    counters = ('hits', 'misses', 'bypasses', 'negatives', 'errors', 'sets')
+    totals = ('get_seconds', 'set_seconds', 'serialized_bytes', 'stored_bytes')
+
+    def __init__(self):
+        self.stats = {}
+
+    def _stats(self, namespace):
+        if namespace not in self.stats:
+            self.stats[namespace] = dict.fromkeys(self.counters + self.totals, 0)
+            self.stats[namespace].update(get_max_seconds=0, set_max_seconds=0)
+        return self.stats[namespace]
+
+    def record(self, namespace, counter):
+        self._stats(namespace)[counter] += 1
+
+    def record_get(self, namespace, hit, seconds):
+        stats = self._stats(namespace)
+        stats['hits' if hit else 'misses'] += 1
+        stats['get_seconds'] += seconds
+        stats['get_max_seconds'] = max(stats['get_max_seconds'], seconds)
+
+    def record_set(self, namespace, serialized_bytes, stored_bytes, seconds):
+        stats = self._stats(namespace)
+        stats['sets'] += 1
+        stats['serialized_bytes'] += serialized_bytes
+        stats['stored_bytes'] += stored_bytes
+        stats['set_seconds'] += seconds
+        stats['set_max_seconds'] = max(stats['set_max_seconds'], seconds)
+
+    def snapshot(self):
+        result = {}
+        for namespace, stats in self.stats.items():
+            gets = stats['hits'] + stats['misses']
+            sets = stats['sets']
+            result[namespace] = {
+                **{counter: stats[counter] for counter in self.counters},
+                'hit_ratio': round(stats['hits'] / gets, 3) if gets else None,
+                'get_ms': {
+                    'mean': round(stats['get_seconds'] / gets * 1000, 2) if gets else None,
+                    'max': round(stats['get_max_seconds'] * 1000, 2),
+                },
+                'set_ms': {
+                    'mean': round(stats['set_seconds'] / sets * 1000, 2) if sets else None,
+                    'max': round(stats['set_max_seconds'] * 1000, 2),
+                },
+                'serialized_bytes': stats['serialized_bytes'],
+                'stored_bytes': stats['stored_bytes'],
+                'mean_stored_bytes': round(stats['stored_bytes'] / sets) if sets else None,
+            }
+        return result
+
+
+cache_telemetry = CacheTelemetry()
+
+
+class CachePolicy:
+    """Caching policy of a function: namespace, schema version, TTL, bypass list and max serialized size.
+
+    Keys are built as `<namespace>:v<version>:<scope>:<digest>`, the scope is the OLC user a key belongs to (if any).
+    Bump the version after changing what a function returns, old keys are then never read again and expire.
     """
-    if args and hasattr(args[0], "__class__"):
-        args = args[1:]
-    args = tuple(a for a in args if not (isinstance(a, str) and a.startswith('_')))
-    kwargs = {k: v for k, v in kwargs.items() if not k.startswith('_')}
-    if args and args[0] == 81464:
-        return f"{func.__name__}:no_cache_{random.randint(1, 1000000)}"  # Disable caching for this user
-    assert len(args) + len(kwargs) > 0, "At least one argument is required to build the cache key"
-    key = f"{func.__name__}:{args}:{kwargs}"
-    return key
+    def __init__(self, namespace, ttl, version=1, scope=None, bypass=(), max_size=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.version = version
+        self.scope = scope  # Callable (args, kwargs) -> user id or None
+        self.bypass = set(bypass)  # Scopes that are never cached
+        self.max_size = max_size  # Max serialized bytes to store
+
+    def prefix(self, scope=None):
+        prefix = f'{self.namespace}:v{self.version}'
+        if scope is not None:
+            prefix += f':{scope}'
+        return prefix
+
+    @staticmethod
+    def _arguments(args, kwargs):
+        """Ignore 'self' and any argument starting with '_'."""
+        args = tuple(a for a in args[1:] if not (isinstance(a, str) and a.startswith('_')))
+        kwargs = {k: v for k, v in kwargs.items() if not k.startswith('_')}
+        return args, kwargs
+
+    def get_scope(self, args, kwargs):
+        if self.scope is None:
+            return None
+        return self.scope(*self._arguments(args, kwargs))
+
+    def key_builder(self, func, *args, **kwargs):
+        args, kwargs = self._arguments(args, kwargs)
+        assert len(args) + len(kwargs) > 0, "At least one argument is required to build the cache key"
+        scope = self.scope(args, kwargs) if self.scope else None
+        arguments = json.dumps([args, kwargs], sort_keys=True, default=repr, separators=(',', ':'))
+        digest = hashlib.blake2b(arguments.encode(), digest_size=12).hexdigest()
+        return f'{self.prefix(scope if scope is not None else "-")}:{digest}'
+
+
+def _olc_pilot_from_url(args, kwargs):
+    # _do_request(method, url, ...), flightbook urls contain the pilot as pi=<user_id>
+    url = args[1] if len(args) > 1 else kwargs.get('url', '')
+    match = re.search(r'[?&]pi=(\d+)', url)
+    return int(match.group(1)) if match else None
+
+
+no_cache_users = {81464}  # OLC users that are never cached
+cache_policies = {
+    policy.namespace: policy for policy in [
+        CachePolicy('olc_request', ttl=60 * 60 * 72, scope=_olc_pilot_from_url, bypass=no_cache_users),
+        CachePolicy('olc_flights', ttl=60 * 60 * 72, scope=lambda args, kwargs: args[0] if args else kwargs.get('user_id'), bypass=no_cache_users),
+        CachePolicy('olc_flight_ref', ttl=60 * 60 * 72),
+        CachePolicy('olc_igc', ttl=60 * 60 * 72, version=2, max_size=2 * 1024 * 1024),  # v2: bytes instead of str
+    ]
+}
+
+
+class policy_cached(cached):
+    """aiocache `cached` using a CachePolicy from cache_policies for the key, TTL, bypass and max size.
+    """
+    def __init__(self, namespace, **kwargs):
+        self.policy = cache_policies[namespace]
+        super().__init__(alias='default', key_builder=self.policy.key_builder, ttl=self.policy.ttl, **kwargs)
+
+    async def decorator(self, f, *args, **kwargs):
+        if self.policy.bypass and self.policy.get_scope(args, kwargs) in self.policy.bypass:
+            cache_telemetry.record(self.policy.namespace, 'bypasses')
+            return await f(*args, **kwargs)
+        return await super().decorator(f, *args, **kwargs)
+
+    async def get_from_cache(self, key):
+        t0 = time.perf_counter()
+        value = await super().get_from_cache(key)
+        cache_telemetry.record_get(self.policy.namespace, value is not None, time.perf_counter() - t0)
+        return value
+
+    async def set_in_cache(self, key, value):
+        t0 = time.perf_counter()
+        try:
+            serializer = self.cache.serializer
+            if hasattr(serializer, 'dumps_sized'):
+                data, serialized_size = serializer.dumps_sized(value)
+            else:
+                data = serializer.dumps(value)
+                serialized_size = None
+            if data is None or (self.policy.max_size and stored_size(data) > self.policy.max_size):
+                # Nothing stored, e.g. None result or too big
+                cache_telemetry.record(self.policy.namespace, 'negatives')
+                logging.debug(f'Not caching value for key: {key}, max is {self.policy.max_size} bytes')
+                return
+            await self.cache.set(key, value, ttl=self.ttl, dumps_fn=lambda _: data)
+        except Exception:
+            cache_telemetry.record(self.policy.namespace, 'errors')
+            logging.exception(f"Couldn't set key {key}, unexpected error")
+        else:
+            size = stored_size(data)
+            cache_telemetry.record_set(self.policy.namespace, serialized_size or size, size, time.perf_counter() - t0)
+
+
+async def invalidate_cache(namespace, scope=None):
+    """Remove all cached keys of a namespace, or only those of one user (scope)."""
+    prefix = cache_policies[namespace].prefix(scope)
+    await caches.get('default').clear(namespace=prefix)
+    logging.info(f'Invalidated cache keys {prefix}:*')
 
 
 class SentryAiocachePlugin(BasePlugin):
@@ -115,11 +277,12 @@ class SentryAiocachePlugin(BasePlugin):
             span.set_data("cache.hit", hit)
             logging.debug(f"Cache {'hit' if hit else 'miss'} for key: {key}")
 
-    async def post_set(self, client, key, value, *args, **kwargs):
+    async def post_set(self, client, key, value, *args, dumps_fn=None, **kwargs):
         with sentry_sdk.start_span(op="cache.put") as span:
             span.set_data("cache.key", [key])
             if value is not None:
-                byte_size = sys.getsizeof(value)
+                # Size as stored in the backend, policy_cached passes the already serialized value
+                byte_size = stored_size((dumps_fn or client.serializer.dumps)(value))
                 span.set_data("cache.item_size", byte_size)
                 logging.debug(f"Cached {byte_size} bytes for key: {key}")
             else:
@@ -130,10 +293,14 @@ class SentryAiocachePlugin(BasePlugin):
 
 class Lz4PickleSerializer(PickleSerializer):
     def dumps(self, value):
-        if value is not None:
-            value = super().dumps(value)
-            value = lz4.frame.compress(value)
-        return value
+        return self.dumps_sized(value)[0]
+
+    def dumps_sized(self, value):
+        """Returns the compressed value and the serialized size before compression."""
+        if value is None:
+            return value, 0
+        value = super().dumps(value)
+        return lz4.frame.compress(value), len(value)
 
     def loads(self, value):
         if value is not None:
@@ -142,17 +309,114 @@ class Lz4PickleSerializer(PickleSerializer):
         return value
 
 
+class ColumnarMsgpackSerializer(BaseSerializer):
+    """Msgpack serializer that stores lists of dicts as columns, LZ4 compressed.
+
+    Stores the repeated OLC field names once per list and does not depend on Python object layout. Not used by any
+    cache: LZ4 already removes most of the repetition, see bench_serializers.py, it is only ~10% smaller than
+    Lz4PickleSerializer and several times slower to encode.
+    Values msgpack cannot represent fall back to Lz4PickleSerializer, which is also used to read old entries.
+    """
+    DEFAULT_ENCODING = None
+    VERSION = b'\x01'  # LZ4 frames start with 0x04, so old pickled entries are recognized
+    TABLE, TUPLE, MISSING = 1, 2, 3
+    _markers = {code: object() for code in (TABLE, TUPLE, MISSING)}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fallback = Lz4PickleSerializer()
+
+    def _encode(self, value):
+        """Tables and tuples become lists starting with a marker extension, decoded again by _list_hook."""
+        if isinstance(value, dict):
+            return {k: self._encode(v) for k, v in value.items()}
+        if isinstance(value, tuple):
+            return [msgpack.ExtType(self.TUPLE, b'')] + [self._encode(v) for v in value]
+        if isinstance(value, list):
+            keys = len(value) > 1 and all(isinstance(row, dict) for row in value) and list(dict.fromkeys(k for row in value for k in row))
+            if keys:
+                # Without keys there are no columns to tell the number of rows, such lists are stored as they are
+                missing = self._markers[self.MISSING]
+                columns = [self._encode([row.get(k, missing) for row in value]) for k in keys]
+                return [msgpack.ExtType(self.TABLE, b''), keys] + columns
+            return [self._encode(v) for v in value]
+        if value is self._markers[self.MISSING]:
+            return msgpack.ExtType(self.MISSING, b'')
+        return value
+
+    def _ext_hook(self, code, data):
+        try:
+            return self._markers[code]
+        except KeyError:
+            raise ValueError(f'Unknown msgpack extension type {code}')
+
+    def _list_hook(self, value):
+        if not value:
+            return value
+        marker = value[0]
+        if marker is self._markers[self.TUPLE]:
+            return tuple(value[1:])
+        if marker is self._markers[self.TABLE]:
+            keys, missing = value[1], self._markers[self.MISSING]
+            return [{k: v for k, v in zip(keys, row) if v is not missing} for row in zip(*value[2:])]
+        return value
+
+    def dumps(self, value):
+        return self.dumps_sized(value)[0]
+
+    def dumps_sized(self, value):
+        """Returns the compressed value and the serialized size before compression."""
+        if value is None:
+            return value, 0
+        try:
+            packed = msgpack.packb(self._encode(value), use_bin_type=True)
+        except (TypeError, ValueError, OverflowError):
+            return self.fallback.dumps_sized(value)
+        return self.VERSION + lz4.frame.compress(packed), len(packed)
+
+    def loads(self, value):
+        if value is None:
+            return value
+        if value[:1] != self.VERSION:
+            return self.fallback.loads(value)
+        return msgpack.unpackb(
+            lz4.frame.decompress(value[1:]),
+            ext_hook=self._ext_hook, list_hook=self._list_hook, raw=False, strict_map_key=False,
+        )
+
+
 status_expiry_seconds = 60*5  # Expire in 5 minutes
 
-def set_upload_status(flight_id, result, status=None):
-    if result is not None:
-        redis_client.set(f"upload_result:{flight_id}", result, ex=status_expiry_seconds)
-    if status is not None:
-        redis_client.set(f"upload_status:{flight_id}", status, ex=status_expiry_seconds)
+async def set_upload_status(flight_id, result, status=None, job_ids=()):
+    if job_ids:
+        # Flights of an upload job live in the job record, merged resubmissions follow the same upload
+        for job_id in job_ids:
+            await set_job_flight_status(job_id, flight_id, result, status)
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        if result is not None:
+            pipe.set(f"upload_result:{flight_id}", result, ex=status_expiry_seconds)
+        if status is not None:
+            pipe.set(f"upload_status:{flight_id}", status, ex=status_expiry_seconds)
+        await pipe.execute()
 
-def get_upload_status(flight_id):
-    result = redis_client.get(f"upload_result:{flight_id}")
-    status = redis_client.get(f"upload_status:{flight_id}")
+def _upload_status(result, status):
     if result is None:
         return {'status': None, 'result': ''}
     return {'status': status, 'result': result}
+
+async def get_upload_status(flight_id):
+    return (await get_upload_statuses([flight_id]))[flight_id]
+
+async def get_upload_statuses(flight_ids):
+    """Read the status of all flights in a single MGET round trip."""
+    if not flight_ids:
+        return {}
+    keys = [f"upload_result:{flight_id}" for flight_id in flight_ids]
+    keys += [f"upload_status:{flight_id}" for flight_id in flight_ids]
+    values = await redis_client.mget(keys)
+    results, statuses = values[:len(flight_ids)], values[len(flight_ids):]
+    return {
+        flight_id: _upload_status(result, status)
+        for flight_id, result, status in zip(flight_ids, results, statuses)
+    }
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from aiocache import RedisCache
+from aiocache.base import API, SENTINEL
+
+
+class LruTtlCache:
+    """Size-bounded in-process LRU with a TTL per entry, holding deserialized objects.
+    """
+    def __init__(self, max_size=512, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self, prefix=None):
+        if prefix is None:
+            self.entries.clear()
+        else:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+
+class NearRedisCache(RedisCache):
+    """RedisCache with an in-process near cache in front of it.
+
+    Hot keys skip both the Redis round trip and the deserialization. Writes are published on a Redis channel,
+    so other processes drop their stale near copy. Values are shared between callers, do not mutate them.
+    """
+    def __init__(self, near_max_size=512, near_ttl=30, invalidation_channel='aiocache:invalidate', **kwargs):
+        super().__init__(**kwargs)
+        self.near = LruTtlCache(max_size=near_max_size, ttl=near_ttl)
+        self.invalidation_channel = invalidation_channel
+        self.instance_id = uuid.uuid4().hex  # Ignore our own invalidations
+        self.listener = None
+
+    def __repr__(self):  # pragma: no cover
+        return f"NearRedisCache ({self.endpoint}:{self.port}, {len(self.near)}/{self.near.max_size} near)"
+
+    def _ensure_listener(self):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.invalidation_channel)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    sender, _, key = message['data'].decode().partition(':')
+                    if sender == self.instance_id:
+                        continue
+                    if key.endswith('*'):
+                        self.near.clear(key[:-1])
+                    else:
+                        self.near.delete(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Invalidations might have been missed, start over with an empty near cache
+                logging.warning(f'Near cache invalidation listener failed: {e}')
+                self.near.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def _clear(self, namespace=None, _conn=None):
+        if not namespace:
+            return await super()._clear(namespace, _conn=_conn)
+        # SCAN instead of KEYS, to not block Redis while invalidating a namespace
+        keys = [key async for key in self.client.scan_iter(match=f'{namespace}:*', count=1000)]
+        for i in range(0, len(keys), 1000):
+            await self.client.delete(*keys[i:i + 1000])
+        return True
+
+    async def _invalidate(self, key):
+        await self.client.publish(self.invalidation_channel, f'{self.instance_id}:{key}')
+
+    @API.aiocache_enabled()
+    @API.timeout
+    @API.plugins
+    async def get(self, key, default=None, loads_fn=None, namespace=None, _conn=None):
+        self._ensure_listener()
+        ns = namespace if namespace is not None else self.namespace
+        ns_key = self.build_key(key, namespace=ns)
+
+        value = self.near.get(ns_key)
+        if value is not None:
+            logging.debug(f'Near cache hit for key: {ns_key}')
+            return value
+
+        loads = loads_fn or self._serializer.loads
+        value = loads(await self._get(ns_key, encoding=self.serializer.encoding, _conn=_conn))
+        if value is None:
+            return default
+        self.near.set(ns_key, value)
+        return value
+
+    @API.aiocache_enabled(fake_return=True)
+    @API.timeout
+    @API.plugins
+    async def set(self, key, value, ttl=SENTINEL, dumps_fn=None, namespace=None, _cas_token=None, _conn=None):
+        self._ensure_listener()
+        dumps = dumps_fn or self._serializer.dumps
+        ns = namespace if namespace is not None else self.namespace
+        ns_key = self.build_key(key, namespace=ns)
+        ttl = self._get_ttl(ttl)
+
+        res = await self._set(ns_key, dumps(value), ttl=ttl, _cas_token=_cas_token, _conn=_conn)
+        self.near.set(ns_key, value, ttl=ttl)
+        await self._invalidate(ns_key)
+        return res
+
+    @API.aiocache_enabled(fake_return=0)
+    @API.timeout
+    @API.plugins
+    async def delete(self, key, namespace=None, _conn=None):
+        ns = namespace if namespace is not None else self.namespace
+        ns_key = self.build_key(key, namespace=ns)
+        self.near.delete(ns_key)
+        await self._invalidate(ns_key)
+        return await self._delete(ns_key, _conn=_conn)
+
+    @API.aiocache_enabled(fake_return=True)
+    @API.timeout
+    @API.plugins
+    async def clear(self, namespace=None, _conn=None):
+        prefix = f'{namespace}:' if namespace else ''
+        self.near.clear(prefix or None)
+        await self._invalidate(f'{prefix}*')
+        return await self._clear(namespace, _conn=_conn)
@@ -7,7 +7,6 @@ from datetime import datetime
 import os
 import aiohttp
 import sentry_sdk
-from aiocache import cached
 from aiohttp import ClientTimeout
 from aiohttp_retry import ExponentialRetry, RetryClient
 from aiohttp_retry.client import _RequestContext
@@ -15,11 +14,13 @@ from lxml import etree
 from requests import JSONDecodeError
 from sentry_sdk import new_scope
 
+from drr_scheduler import lanes
 from gliders import weglide_find_closest_gliders
-from misc import cache_key_builder, format_registration
+from misc import format_registration, policy_cached
 
 # TODO make this dynamic
 flights_max = 200  # Max number of flights to fetch from OLC per user
+season_concurrency = 3  # Max number of seasons fetched in parallel per user
 olc_timeout = 30  # 30 seconds timeout for OLC requests
 
 # OLC will fail fast when it's stalling the response, proxy is allowed more time
@@ -83,6 +84,44 @@ class OlcRequestError(Exception):
     pass
 
 
+class SeasonFetchPlanner:
+    """Fetch seasons from newest to oldest with bounded concurrency.
+
+    Results are consumed in season order, so the flights cap always keeps the newest seasons.
+    Once the cap is reached, outstanding requests are cancelled and the cursor points to the next season.
+    """
+    def __init__(self, start_year: int, end_year: int, limit=flights_max, concurrency=season_concurrency):
+        self.years = list(range(end_year, start_year - 1, -1))
+        self.limit = limit
+        self.concurrency = concurrency
+        self.cursor = None  # Next (older) season to fetch, None when all seasons are fetched
+        self.cancelled = 0
+
+    async def run(self, fetch_season):
+        """Run fetch_season(year) for each season, returns the concatenated results."""
+        results = []
+        tasks = {}
+        try:
+            for i, year in enumerate(self.years):
+                # Keep a window of seasons in flight ahead of the one being consumed
+                for ahead in self.years[i:i + self.concurrency]:
+                    if ahead not in tasks:
+                        tasks[ahead] = asyncio.ensure_future(fetch_season(ahead))
+                try:
+                    results.extend(await tasks.pop(year))
+                except OlcRequestError:
+                    continue
+                if len(results) >= self.limit:
+                    if i + 1 < len(self.years):
+                        self.cursor = self.years[i + 1]
+                    break
+        finally:
+            for task in tasks.values():
+                if task.cancel():
+                    self.cancelled += 1
+        return results
+
+
 class ProxyRetryClient(RetryClient):
     """RetryClient that adds a proxy on retries, but not on the first attempt.
     """
@@ -137,7 +176,7 @@ class OlcInterface:
     user_locks = {}
 
     def __init__(self, user=os.environ['VITE_OLC_DEFAULT_USER'], password=os.environ['VITE_OLC_DEFAULT_PASSWORD']):
-        self.base = 'https://www.onlinecontest.org/olc-3.0/'
+        self.base = os.environ.get('OLC_BASE_URL') or 'https://www.onlinecontest.org/olc-3.0/'
         self.proxy = os.environ.get('SCRAPERAPI_PROXY_URL')
         if not any(c.isalpha() for c in user):
             raise ValueError('username cannot be all numbers, fill your OLC username, not your ID')
@@ -183,6 +222,9 @@ class OlcInterface:
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
         if self.retry_client is not None:
             await self.retry_client.close()
 
@@ -242,7 +284,7 @@ class OlcInterface:
                     wait_time = (t1 - t0) * 1000
                     logging.info(f"Login OLC for user {self.user} succeeded in {wait_time:.0f}ms")
 
-    @cached(alias='default', key_builder=cache_key_builder, ttl=60 * 60 * 72)
+    @policy_cached('olc_request')
     async def _do_request(self, method, url, *args, **kwargs):
         with sentry_sdk.start_span(op='request', name='_do_request') as span:
             span.set_data('request', method)
@@ -289,68 +331,68 @@ class OlcInterface:
                     return await self._do_request(method, url, *args, proxy=self.proxy, **kwargs)
                 raise OlcRequestError('Took too long to fetch flights from OLC, try less flights at once') from e
 
-    @cached(alias='default', key_builder=cache_key_builder, ttl=60 * 60 * 72)
     async def fetch_flights(self, user_id: int, start_year: int, end_year: int = None, _scrape=True):
+        flights, _ = await self.fetch_flights_page(user_id, start_year, end_year, _scrape=_scrape)
+        return flights
+
+    @policy_cached('olc_flights')
+    async def fetch_flights_page(self, user_id: int, start_year: int, end_year: int = None, _scrape=True):
+        """Fetch flights newest season first, returns the flights and a cursor.
+
+        The cursor is the next (older) season to pass as end_year to continue fetching, or None when done.
+        """
         with sentry_sdk.start_span(op='request', name='fetch_flights') as span:
             # assert 2007 <= start_year <= 2030, 'Invalid start year: <2007 or >2030'
-            year = end_year or datetime.now().year
+            end_year = end_year or datetime.now().year
+            planner = SeasonFetchPlanner(start_year, end_year)
+            span.set_data('olc_seasons', len(planner.years))
 
-            tasks = []
-            while year >= start_year:
+            async def fetch_season(year):
                 competition_type = 'olcp'
                 if year <= 2010:
                     # OLC Plus exists from October 2010
                     competition_type = 'olc'
 
-                with sentry_sdk.start_span(op='request', name='prepare_task') as inner_span:
+                with sentry_sdk.start_span(op='request', name='fetch_season') as inner_span:
                     inner_span.set_data('year', year)
                     inner_span.set_data('user_id', user_id)
                     inner_span.set_data('competition_type', competition_type)
-                    tasks.append(self._do_request('POST', f'gliding/flightbook.html?sp={year}&pi={user_id}', json={
+                    response = await lanes.submit('olc_json', user_id, self._do_request('POST', f'gliding/flightbook.html?sp={year}&pi={user_id}', json={
                         "q": "ds",
                         "st": competition_type,
                         "offset": 0,
                         "limit": 2147483647
-                    }, headers={'Accept': 'application/json'}))
-                year -= 1
-            span.set_data('olc_tasks', len(tasks))
+                    }, headers={'Accept': 'application/json'}), priority='interactive')
+                    return response['result']
 
             flights = []
             scrape_tasks = []
-            with sentry_sdk.start_span(op='request', name='prepare_task'):
-                for task in asyncio.as_completed(tasks):
-                    with sentry_sdk.start_span(op='request', name='await_task'):
-                        if len(flights) > flights_max:
-                            logging.info(f'Stopping fetching flights after {flights_max} flights for user {user_id}')
-                            break
-
-                        try:
-                            response = await task
-                        except OlcRequestError:
-                            continue
-
-                        for flight in response['result']:
-                            flight['airplane_weglide'] = weglide_find_closest_gliders(flight['airplane'])[0]
-                            flight['date'] = datetime.utcfromtimestamp(flight['dateOfFlight'] / 1000).date().isoformat()
-                            flight['distanceInKm'] = round(flight['distanceInKm'], 1)
-                            flight['speedInKmH'] = round(flight['speedInKmH'], 1)
-                            flight['checked'] = True
-                            copilot = flight.get('copilot')
-                            if copilot:
-                                copilot = copilot['firstName'] + ' ' + copilot['surName']
-                                flight['co_pilot_name'] = copilot
-                            if _scrape:
-                                scrape_tasks.append(self.scrape_flight(flight))
-                            flights.append(flight)
+            for flight in await planner.run(fetch_season):
+                flight = dict(flight)  # The seasons may be shared near cache values, annotate a copy
+                flight['airplane_weglide'] = weglide_find_closest_gliders(flight['airplane'])[0]
+                flight['date'] = datetime.utcfromtimestamp(flight['dateOfFlight'] / 1000).date().isoformat()
+                flight['distanceInKm'] = round(flight['distanceInKm'], 1)
+                flight['speedInKmH'] = round(flight['speedInKmH'], 1)
+                flight['checked'] = True
+                copilot = flight.get('copilot')
+                if copilot:
+                    copilot = copilot['firstName'] + ' ' + copilot['surName']
+                    flight['co_pilot_name'] = copilot
+                if _scrape:
+                    scrape_tasks.append(lanes.submit('olc_html', user_id, self.scrape_flight(flight), priority='interactive'))
+                flights.append(flight)
             span.set_data('olc_fetched_flights', len(flights))
+            span.set_data('olc_cancelled_seasons', planner.cancelled)
+            if planner.cursor is not None:
+                logging.info(f'Stopped fetching flights after {len(flights)} flights for user {user_id}, next season {planner.cursor}')
 
             if _scrape:
                 span.set_data('scrape_tasks' , len(scrape_tasks))
                 with sentry_sdk.start_span(op='request', name='scrape_tasks'):
                     await asyncio.gather(*scrape_tasks, return_exceptions=True)
-            return sorted(flights, key=lambda flight: int(flight['id']))
+            return sorted(flights, key=lambda flight: int(flight['id'])), planner.cursor
 
-    @cached(alias='default', key_builder=cache_key_builder, ttl=60 * 60 * 72)
+    @policy_cached('olc_flight_ref')
     async def fetch_flight_ref(self, flight_id: int):
         with sentry_sdk.start_span(op='request', name='fetch_flight_ref') as span:
             json_response = await self._do_request('GET', f'gliding/rest/flightstatistics.json?dsIds={flight_id}')
@@ -360,7 +402,7 @@ class OlcInterface:
             span.set_data('olc_fetch_flight_ref_success', 1)
             return int(ref)
 
-    @cached(alias='default', key_builder=cache_key_builder, ttl=60 * 60 * 72)
+    @policy_cached('olc_igc')
     async def fetch_igc(self, flight_ref: int, _retry=True, _head=False, **kwargs):
         with sentry_sdk.start_span(op='request', name='fetch_igc') as span:
             logging.info(f'Fetching OLC IGC for user "{self.user}" with ref "{flight_ref}"')
@@ -389,17 +431,9 @@ class OlcInterface:
                     assert 'application/igc' in response.headers['Content-Type'], 'Not an IGC file'
                     # _, _, filename = response.headers['Content-Disposition'].partition('filename=')
                     # logging.info(f'Fetched OLC IGC {filename}')
-                    try:
-                        data = await response.text()
-                    except UnicodeDecodeError:
-                        raw_data = await response.read()
-                        try:
-                            data = raw_data.decode('latin-1')
-                        except UnicodeDecodeError as e:
-                            scope = sentry_sdk.get_current_scope()
-                            scope.add_attachment(bytes=raw_data, filename=str(flight_ref))
-                            span.set_data('olc_fetch_igc_fail', 1)
-                            raise OlcRequestError(f'Could not decode IGC: {flight_ref}') from e
+                    # Kept as the bytes OLC sent, IGC files are ASCII but some loggers write latin-1 in the headers
+                    data = await response.read()
+                    span.set_data('igc_bytes', len(data))
                     filename = f'{abs(int(flight_ref))}.igc'  # Filename in IGC file might be malformed, containing slashes, makes WeGlide reject
                     span.set_data('olc_fetch_igc_success', 1)
                     t1 = time.perf_counter()
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+
+from drr_scheduler import DecayingHistogram, FairQueue
+
+
+class FairStageQueue:
+    """Bounded queue handing out items round robin between keys (DRR), so one user's backlog cannot fill a stage.
+
+    Producers blocked on a full queue are let in round robin between keys as well, not in arrival order.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.fair = FairQueue()
+        self.waiting = FairQueue()  # Entries of blocked producers, with the future that unblocks them
+        self.ready = asyncio.Event()  # Set when an item was added
+
+    def qsize(self):
+        return self.fair.queued
+
+    def full(self):
+        return self.fair.queued >= self.maxsize
+
+    def _add(self, key, entry):
+        self.fair.append(key, [entry], 1)
+        self.ready.set()
+
+    def offer(self, key, entry):
+        """Add entry, or return a future that is done once it is let in, the entry is dropped if it is cancelled."""
+        if not self.full():
+            self._add(key, entry)
+            return None
+        admitted = asyncio.get_event_loop().create_future()
+        self.waiting.append(key, [(entry, admitted)], 1)
+        return admitted
+
+    async def put(self, key, entry):
+        admitted = self.offer(key, entry)
+        if admitted:
+            await admitted
+
+    async def get(self):
+        while not self.fair.queued:
+            self.ready.clear()
+            await self.ready.wait()
+        _, entry = self.fair.pop()
+        while self.waiting.queued and not self.full():
+            key, (waiting_entry, admitted) = self.waiting.pop()
+            if not admitted.cancelled():
+                admitted.set_result(None)
+                self._add(key, waiting_entry)
+        return entry
+
+
+class Stage:
+    def __init__(self, name, fn, workers, queue_size, clock=time.monotonic):
+        self.name = name; self.fn = fn; self.workers = workers
+        self.queue = FairStageQueue(queue_size)  # Items waiting for this stage
+        self.busy = 0; self.processed = 0; self.stopped = 0
+        self.wait = DecayingHistogram(clock=clock)
+        self.service = DecayingHistogram(clock=clock)
+
+    def snapshot(self):
+        return {
+            'workers': self.workers, 'busy': self.busy, 'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize,
+            'blocked': self.queue.waiting.queued,
+            'processed': self.processed, 'stopped': self.stopped,
+            'wait_sec': {'p50': self.wait.quantile(0.5), 'p90': self.wait.quantile(0.9)},
+            'service_time_sec': {'mean': self.service.mean(), 'p50': self.service.quantile(0.5), 'p90': self.service.quantile(0.9)},
+        }
+
+
+class StagedPipeline:
+    """Items pass the stages in order, stages are connected by bounded queues and each has its own workers.
+
+    A stage function returns False when it finished the item early. A full queue blocks the workers of the
+    stage before it, so a slow stage holds back the stages upstream instead of piling up work, while the
+    other stages keep working on the next items. Every stage takes the items in its queue round robin between
+    their keys, so a user with a large batch does not push the others back inside the pipeline.
+    """
+    def __init__(self, stages, queue_size=16, key=lambda item: None, on_error=None, clock=time.monotonic):
+        self.stages = [Stage(name, fn, workers, queue_size, clock) for name, fn, workers in stages]
+        self.key = key  # Fairness key of an item, e.g. its user
+        self.on_error = on_error  # Called with the item and the exception a stage function raised
+        self.clock = clock
+        self.pending = 0  # Items in the pipeline
+        self.latency = DecayingHistogram(clock=clock)
+
+    async def process(self, item):
+        """Pass item through the stages, returns True when it passed all of them."""
+        finished = asyncio.get_event_loop().create_future()
+        self.pending += 1
+        admitted = self.stages[0].queue.offer(self.key(item), (item, finished, self.clock(), self.clock()))
+        try:
+            if admitted:
+                await admitted
+        except asyncio.CancelledError:
+            finished.cancel()  # Let in just before, the workers drop and finish it
+            if admitted.cancelled():
+                self.pending -= 1  # Never entered, no stage will finish it
+            raise
+        return await finished
+
+    def _finish(self, finished, submitted, completed):
+        self.pending -= 1
+        if not finished.done():
+            finished.set_result(completed)
+        self.latency.update(self.clock() - submitted)
+
+    async def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item, finished, submitted, queued_at = await stage.queue.get()
+            if finished.cancelled():
+                # Whoever waits for it is gone, e.g. the queue worker was stopped
+                self._finish(finished, submitted, False)
+                continue
+            stage.wait.update(self.clock() - queued_at)
+            stage.busy += 1
+            t0 = self.clock()
+            try:
+                proceed = await stage.fn(item) is not False
+            except Exception as e:
+                proceed = False
+                logging.error(f'Error in pipeline stage {stage.name}: {e}')
+                if self.on_error:
+                    try:
+                        await self.on_error(item, e)
+                    except Exception as e:
+                        logging.error(f'Error handler of pipeline stage {stage.name} failed: {e}')
+            finally:
+                stage.busy -= 1
+            stage.service.update(self.clock() - t0)
+            stage.processed += 1
+            if not proceed:
+                stage.stopped += 1
+                self._finish(finished, submitted, False)
+            elif next_stage:
+                await next_stage.queue.put(self.key(item), (item, finished, submitted, self.clock()))
+            else:
+                self._finish(finished, submitted, True)
+
+    async def run(self):
+        await asyncio.gather(*[self._work(index) for index, stage in enumerate(self.stages) for _ in range(stage.workers)])
+
+    def service_times(self):
+        """Time from entering until leaving the pipeline, waits in the queues included."""
+        return self.latency.mean(), self.latency.quantile(0.5), self.latency.quantile(0.9), self.latency.quantile(0.99)
+
+    def throughput(self):
+        """Items per second the slowest stage can process with its workers, None before any stage measured."""
+        rates = [stage.workers / stage.service.mean() for stage in self.stages if stage.service.mean()]
+        return min(rates) if rates else None
+
+    def snapshot(self):
+        s_mean, s50, s90, s99 = self.service_times()
+        return {
+            'pending': self.pending, 'throughput': self.throughput(),
+            'latency_sec': {'mean': s_mean, 'p50': s50, 'p90': s90, 'p99': s99},
+            'stages': {stage.name: stage.snapshot() for stage in self.stages},
+        }
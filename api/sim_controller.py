@@ -0,0 +1,84 @@
+"""Deterministic simulation of the concurrency controllers against synthetic upstream latency curves.
+
+Always backlogged work, virtual time and a seeded RNG, so every run gives the same numbers.
+Exits non-zero when GradientCap misses an expectation.
+
+Usage: python sim_controller.py
+"""
+import heapq
+import random
+import sys
+
+from drr_scheduler import AdaptiveCap, GradientCap
+
+
+class Upstream:
+    """Service time grows linearly with concurrency above the knee, with optional errors above a limit."""
+    def __init__(self, base=0.2, knee=1000, error_above=None, slowdown_at=None, slow_knee=None):
+        self.base = base; self.knee = knee; self.error_above = error_above
+        self.slowdown_at = slowdown_at; self.slow_knee = slow_knee
+
+    def call(self, now, inflight, rng):
+        knee = self.slow_knee if self.slowdown_at is not None and now >= self.slowdown_at else self.knee
+        latency = self.base * max(1.0, inflight / knee) * rng.lognormvariate(0, 0.1)
+        ok = self.error_above is None or inflight <= self.error_above or rng.random() > 0.5
+        return latency, ok
+
+
+def simulate(controller, upstream, duration=600.0, seed=42):
+    rng = random.Random(seed)
+    now = 0.0
+    inflight = 0
+    completions = []  # heap of (finished_at, latency, ok)
+    latencies = []
+    errors = 0
+    caps = []  # (time, cap)
+    while now < duration:
+        while inflight < controller.cap:
+            inflight += 1
+            latency, ok = upstream.call(now, inflight, rng)
+            heapq.heappush(completions, (now + latency, latency, ok))
+        now, latency, ok = heapq.heappop(completions)
+        controller.record(ok, latency, inflight)
+        inflight -= 1
+        latencies.append(latency)
+        errors += not ok
+        caps.append((now, controller.cap))
+    latencies.sort()
+
+    def cap_between(start, end):
+        window = [cap for t, cap in caps if start <= t < end]
+        return sum(window) / len(window)
+
+    return {
+        'throughput': (len(latencies) - errors) / duration,
+        'p50': latencies[len(latencies) // 2],
+        'p90': latencies[int(len(latencies) * 0.9)],
+        'errors': errors / len(latencies),
+        'cap_first': cap_between(0, duration / 2),
+        'cap_last': cap_between(duration * 0.9, duration),
+    }
+
+
+scenarios = {
+    # name: (upstream, expectation on the GradientCap result)
+    'unlimited': (Upstream(), lambda r: r['cap_last'] >= 56),
+    'knee at 8': (Upstream(knee=8), lambda r: r['cap_last'] <= 16 and r['p90'] < 0.2 * 2.5),
+    'knee 24 -> 6 at 300s': (Upstream(knee=24, slowdown_at=300, slow_knee=6), lambda r: r['cap_first'] > 20 and r['cap_last'] <= 12),
+    'errors above 12': (Upstream(error_above=12), lambda r: r['errors'] < 0.1 and r['cap_last'] <= 12),
+}
+
+if __name__ == '__main__':
+    failed = []
+    print(f"{'scenario':<24}{'controller':<14}{'ok/s':>8}{'p50 s':>8}{'p90 s':>8}{'errors':>8}{'cap 1st':>9}{'cap end':>9}")
+    for name, (upstream, expect) in scenarios.items():
+        for controller in (AdaptiveCap(floor=4, ceiling=64), GradientCap(floor=4, ceiling=64)):
+            r = simulate(controller, upstream)
+            verdict = ''
+            if isinstance(controller, GradientCap):
+                verdict = 'ok' if expect(r) else 'FAIL'
+                if verdict == 'FAIL':
+                    failed.append(name)
+            print(f"{name:<24}{controller.__class__.__name__:<14}{r['throughput']:>8.1f}{r['p50']:>8.3f}{r['p90']:>8.3f}"
+                  f"{r['errors']:>8.1%}{r['cap_first']:>9.1f}{r['cap_last']:>9.1f}  {verdict}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,235 @@
+"""Simulate the upload pipeline under load: the real DRR schedulers and controllers against synthetic upstreams.
+
+Runs on an event loop with virtual time and a seeded RNG, offline and deterministic, so scheduler changes
+can be compared on numbers. Each scenario runs once with AdaptiveCap and once with GradientCap in the lanes.
+
+Usage: python sim_scheduler.py [scenario|all] [seed]
+"""
+import asyncio
+import logging
+import random
+import statistics
+import sys
+
+from drr_scheduler import AdaptiveCap, DRRScheduler, GradientCap, SchedulerLanes
+from pipeline import StagedPipeline
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop that jumps to the next timer instead of waiting for it."""
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def _run_once(self):
+        if not self._ready and self._scheduled:
+            self.now = max(self.now, self._scheduled[0].when())
+        super()._run_once()
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class SimUpstream:
+    """Service time grows linearly with concurrency above the knee, random errors and 429 storms."""
+    def __init__(self, rng, base, knee, error_rate=0.0, storms=(), slowdowns=()):
+        self.rng = rng; self.base = base; self.knee = knee; self.error_rate = error_rate
+        self.storms = storms  # (start, end): most requests fail fast with 429
+        self.slowdowns = slowdowns  # (start, end, factor)
+        self.inflight = 0
+
+    async def call(self):
+        loop = asyncio.get_running_loop()
+        self.inflight += 1
+        try:
+            now = loop.time()
+            if any(start <= now < end for start, end in self.storms) and self.rng.random() < 0.8:
+                await asyncio.sleep(0.05)
+                raise UpstreamError('429 Too Many Requests')
+            factor = 1.0
+            for start, end, slowdown in self.slowdowns:
+                if start <= now < end:
+                    factor *= slowdown
+            await asyncio.sleep(self.base * factor * max(1.0, self.inflight / self.knee) * self.rng.lognormvariate(0, 0.25))
+            if self.rng.random() < self.error_rate:
+                raise UpstreamError('error')
+        finally:
+            self.inflight -= 1
+
+
+def batch_size(rng):
+    # Mostly a handful of flights, sometimes a season, now and then a whole archive
+    r = rng.random()
+    if r < 0.7:
+        return rng.randint(1, 10)
+    if r < 0.95:
+        return rng.randint(10, 60)
+    return rng.randint(100, 400)
+
+
+scenarios = {
+    # name: (arrivals per second, arrival window seconds, upstream overrides)
+    'steady': (0.02, 1800, {}),
+    '429 storm': (0.02, 1800, {'olc_igc': {'storms': ((600, 780),)}}),
+    'weglide slowdown': (0.02, 1800, {'weglide_upload': {'slowdowns': ((300, 900, 4.0),)}}),
+    'archive migration': (0.02, 1800, {'big_users': 3}),
+}
+
+upstream_profiles = {
+    'olc_json': dict(base=0.4, knee=12, error_rate=0.01),
+    'olc_html': dict(base=0.8, knee=8, error_rate=0.01),
+    'olc_igc': dict(base=1.0, knee=8, error_rate=0.02),
+    'weglide_upload': dict(base=2.0, knee=2, error_rate=0.01),
+    'weglide_meta': dict(base=0.3, knee=6, error_rate=0.005),
+}
+
+
+def percentiles(values):
+    if not values:
+        return (0.0, 0.0, 0.0)
+    values = sorted(values)
+    return tuple(values[min(len(values) - 1, int(len(values) * q))] for q in (0.5, 0.9, 0.99))
+
+
+def jain(values):
+    values = [v for v in values if v > 0]
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values)) if values else 1.0
+
+
+async def simulate(scenario, controller, seed, sample_interval=60):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    arrival_rate, window, overrides = scenarios[scenario]
+    overrides = dict(overrides)
+    big_users = overrides.pop('big_users', 0)
+
+    # The workload is drawn up front from its own RNG so every controller sees the same users and batches
+    arrivals = [(0.0, f'archive{user}', rng.randint(800, 1200)) for user in range(big_users)]
+    now = rng.expovariate(arrival_rate)
+    while now < window:
+        arrivals.append((now, f'user{len(arrivals)}', batch_size(rng)))
+        now += rng.expovariate(arrival_rate)
+    upstreams = {
+        name: SimUpstream(random.Random(f'{seed}:{name}'), **dict(profile, **overrides.get(name, {})))
+        for name, profile in upstream_profiles.items()
+    }
+    admission = DRRScheduler(AdaptiveCap(floor=4, ceiling=32), clock=loop.time)
+    lanes = SchedulerLanes({
+        'olc_json': DRRScheduler(controller(floor=4, ceiling=32), clock=loop.time),
+        'olc_html': DRRScheduler(controller(floor=4, ceiling=16), clock=loop.time),
+        'olc_igc': DRRScheduler(controller(floor=4, ceiling=16), clock=loop.time),
+        'weglide_upload': DRRScheduler(controller(floor=2, ceiling=2), clock=loop.time),
+        'weglide_meta': DRRScheduler(controller(floor=2, ceiling=8), clock=loop.time),
+    })
+
+    def stage(lane):
+        async def call(user):
+            try:
+                await lanes.submit(lane, user, upstreams[lane].call())
+            except UpstreamError:
+                return False  # Reported in the upload status, not retried
+        return call
+
+    # Same stages and workers as upload_pipeline
+    pipeline = StagedPipeline([
+        ('resolve', stage('olc_json'), 8),
+        ('download', stage('olc_igc'), 8),
+        ('upload', stage('weglide_upload'), 2),
+        ('enrich', stage('weglide_meta'), 4),
+    ], queue_size=16, key=lambda user: user, clock=loop.time)
+    runners = [asyncio.ensure_future(admission.run()), asyncio.ensure_future(lanes.run()), asyncio.ensure_future(pipeline.run())]
+
+    admission_waits = []
+    sojourns = []
+    listings = []
+    users = {}  # user -> [flights, submitted, finished, ok]
+    uploads = []
+    caps = {name: [] for name in ['admission'] + list(lanes.lanes)}
+
+    async def enter(user, submitted):
+        admission_waits.append(loop.time() - submitted)
+        return await pipeline.process(user)
+
+    async def upload(user, submitted):
+        # Like the queue worker: the scheduler decides which uploads are in the pipeline
+        if await admission.enqueue_one(user, enter(user, submitted), op='upload'):
+            users[user][3] += 1
+        sojourns.append(loop.time() - submitted)
+        users[user][2] = loop.time()
+
+    async def listing(user):
+        started = loop.time()
+        seasons = [lanes.submit('olc_json', user, upstreams['olc_json'].call(), priority='interactive') for _ in range(3)]
+        await asyncio.gather(*seasons, return_exceptions=True)
+        scrapes = [lanes.submit('olc_html', user, upstreams['olc_html'].call(), priority='interactive') for _ in range(5)]
+        await asyncio.gather(*scrapes, return_exceptions=True)
+        listings.append(loop.time() - started)
+
+    async def session(user, flights):
+        await listing(user)
+        submitted = loop.time()
+        users[user] = [flights, submitted, submitted, 0]
+        uploads.extend(asyncio.ensure_future(upload(user, submitted)) for _ in range(flights))
+
+    async def sample_caps():
+        while True:
+            caps['admission'].append(admission.adaptive.cap)
+            for name, scheduler in lanes.lanes.items():
+                caps[name].append(scheduler.adaptive.cap)
+            await asyncio.sleep(sample_interval)
+
+    sampler = asyncio.ensure_future(sample_caps())
+    sessions = []
+    for at, user, flights in arrivals:
+        await asyncio.sleep(at - loop.time())
+        sessions.append(asyncio.ensure_future(session(user, flights)))
+    await asyncio.gather(*sessions)
+    await asyncio.gather(*uploads)
+    makespan = loop.time()
+    for task in runners + [sampler]:
+        task.cancel()
+    await asyncio.gather(*runners, sampler, return_exceptions=True)
+
+    total = sum(u[0] for u in users.values())
+    ok = sum(u[3] for u in users.values())
+    # Fairness: successful uploads per second each user got while their batch was in the system
+    rates = [u[3] / max(1e-9, u[2] - u[1]) for u in users.values()]
+    return {
+        'uploads': total, 'ok': ok, 'throughput': ok / makespan, 'makespan': makespan, 'users': len(users),
+        'jain': jain(rates),
+        'admission_wait': percentiles(admission_waits), 'sojourn': percentiles(sojourns), 'listing': percentiles(listings),
+        'caps': caps,
+    }
+
+
+def run(scenario, controller, seed):
+    loop = VirtualTimeLoop()
+    try:
+        return loop.run_until_complete(simulate(scenario, controller, seed))
+    finally:
+        loop.close()
+
+
+def report(scenario, controller, r):
+    print(f"{scenario} / {controller.__name__}: {r['users']} users, {r['uploads']} uploads, {r['ok']} ok, "
+          f"{r['throughput']:.2f} ok/s, makespan {r['makespan']:.0f}s, Jain {r['jain']:.3f}")
+    for name in ('admission_wait', 'sojourn', 'listing'):
+        p50, p90, p99 = r[name]
+        print(f"  {name:<16} p50 {p50:>8.1f}s  p90 {p90:>8.1f}s  p99 {p99:>8.1f}s")
+    for name, caps in r['caps'].items():
+        every = max(1, len(caps) // 12)
+        print(f"  cap {name:<16} mean {statistics.mean(caps):>5.1f}  " + ' '.join(f'{cap:>3}' for cap in caps[::every]))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.ERROR)  # Failed simulated upstream calls are expected
+    selected = sys.argv[1] if len(sys.argv) > 1 else 'all'
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    for scenario in (scenarios if selected == 'all' else [selected]):
+        for controller in (AdaptiveCap, GradientCap):
+            report(scenario, controller, run(scenario, controller, seed))
+        print()
@@ -0,0 +1,279 @@
+"""Local stand-ins for the OLC and WeGlide endpoints used by the API, for load tests without touching the real services.
+
+Point the API at them with:
+    OLC_BASE_URL=http://localhost:8081/olc-3.0/ WEGLIDE_BASE_URL=http://localhost:8082/v1/
+
+Every server adds latency, throttles with 429 above a concurrency or rate limit and injects 500s.
+Flights are generated deterministically from the pilot id and season. GET /_stats returns request counters.
+
+Usage: python standin_servers.py [--latency 0.2] [--max-inflight 16] [--rate 50] [--error-rate 0.01]
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import math
+import random
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from gliders import gliders
+
+olc_port = 8081
+weglide_port = 8082
+flights_per_season = 25
+first_season = 2007
+
+
+class Behaviour:
+    """Latency, throttling and failure injection, applied as middleware to every request."""
+    def __init__(self, latency=0.2, jitter=0.25, max_inflight=16, rate=50.0, error_rate=0.01, seed=1):
+        self.latency = latency; self.jitter = jitter; self.max_inflight = max_inflight
+        self.rate = rate; self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.inflight = 0
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.started = time.monotonic()
+        self.statuses = collections.Counter()
+        self.endpoints = collections.Counter()
+
+    def _take_token(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path.endswith('/_stats'):
+            return await handler(request)
+        self.endpoints[getattr(request.match_info.route.resource, 'canonical', request.path)] += 1
+        if self.inflight >= self.max_inflight or not self._take_token():
+            self.statuses[429] += 1
+            return web.Response(status=429, text='Too Many Requests')
+        self.inflight += 1
+        try:
+            await asyncio.sleep(self.latency * self.rng.lognormvariate(0, self.jitter))
+            if self.rng.random() < self.error_rate:
+                self.statuses[500] += 1
+                return web.Response(status=500, text='Internal Server Error')
+            response = await handler(request)
+            self.statuses[response.status] += 1
+            return response
+        finally:
+            self.inflight -= 1
+
+    async def stats(self, request):
+        elapsed = time.monotonic() - self.started
+        requests = sum(self.statuses.values())
+        return web.json_response({
+            'requests': requests,
+            'requests_per_second': round(requests / elapsed, 1),
+            'inflight': self.inflight,
+            'statuses': {str(status): n for status, n in self.statuses.items()},
+            'endpoints': dict(self.endpoints),
+        })
+
+
+def season_flights(pilot_id, year):
+    """The flights of a pilot in a season, the same on every call."""
+    rng = random.Random(f'{pilot_id}:{year}')
+    names = list(gliders)
+    flights = []
+    for i in range(flights_per_season):
+        day = datetime(year, 4, 1, tzinfo=timezone.utc).timestamp() + rng.randint(0, 180) * 86400
+        distance = rng.uniform(50, 900)
+        flights.append({
+            'id': flight_id(pilot_id, year, i),
+            'dateOfFlight': int(day * 1000),
+            'airplane': rng.choice(names),
+            'distanceInKm': distance,
+            'speedInKmH': rng.uniform(60, 140),
+            'points': distance * 1.1,
+            'pilot': {'id': pilot_id, 'firstName': 'Load', 'surName': f'Test {pilot_id}'},
+            'copilot': None,
+            'club': {'name': 'Stand-in Club'},
+            'takeoff': {'name': 'Stand-in Airfield'},
+        })
+    return flights
+
+
+def flight_id(pilot_id, year, i):
+    return pilot_id * 100000 + (year - first_season) * 100 + i
+
+
+def flight_ref(olc_flight_id):
+    return olc_flight_id + 7
+
+
+def listed_flight(olc_flight_id):
+    pilot_id, rest = divmod(olc_flight_id, 100000)
+    return season_flights(pilot_id, first_season + rest // 100)[rest % 100]
+
+
+def make_igc(rng, day, fixes, interval=1, speed_kmh=90.0, ground=120):
+    """A plausible IGC file with a B-record every interval seconds, standing still for ground seconds before and after."""
+    lat, lon, alt = 50 + rng.uniform(-0.5, 0.5), 8 + rng.uniform(-0.5, 0.5), 500
+    heading = rng.uniform(0, 2 * math.pi)
+    step = speed_kmh / 3.6 * interval / 111320  # Degrees latitude per fix
+    lines = ['AXXXSTANDIN', f'HFDTE{day:%d%m%y}', 'HFPLTPILOTINCHARGE:Load Test', 'HFGTYGLIDERTYPE:Stand-in', 'HFGIDGLIDERID:D-0000']
+    for i in range(fixes):
+        t = (36000 + i * interval) % 86400
+        if ground <= i * interval <= (fixes - 1) * interval - ground:
+            heading += rng.uniform(-0.3, 0.3)
+            lat += step * math.cos(heading)
+            lon += step * math.sin(heading) / math.cos(math.radians(lat))
+            alt = max(200, alt + rng.randint(-3, 3) * interval)
+        # Thousandths of a minute
+        lat_min, lon_min = round(lat * 60000), round(lon * 60000)
+        lines.append(
+            f'B{t // 3600:02d}{t // 60 % 60:02d}{t % 60:02d}'
+            f'{lat_min // 60000:02d}{lat_min % 60000:05d}N{lon_min // 60000:03d}{lon_min % 60000:05d}EA{alt:05d}{alt + 20:05d}'
+        )
+    lines.append('GSTANDIN')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+@functools.lru_cache(maxsize=64)
+def igc_file(ref, interval=4):
+    """IGC file of the flight behind ref as bytes, flying a bit more than its distance at its speed."""
+    flight = listed_flight(ref - 7)
+    day = datetime.fromtimestamp(flight['dateOfFlight'] / 1000, timezone.utc)
+    seconds = flight['distanceInKm'] / flight['speedInKmH'] * 3600 * 1.1
+    return make_igc(random.Random(ref), day, int(seconds / interval) + 60, interval, flight['speedInKmH']).encode()
+
+
+def make_olc_app(behaviour):
+    async def login(request):
+        form = await request.post()
+        if form.get('_name__') == 'wrong':
+            return web.Response(text='<html><body>Faulty entry</body></html>', content_type='text/html')
+        response = web.Response(text='<html><body>Welcome</body></html>', content_type='text/html')
+        response.set_cookie('OLCAUTH', f"standin-{form.get('_ident_')}", path='/')
+        return response
+
+    async def flightbook(request):
+        year = int(request.query['sp'])
+        pilot_id = int(request.query['pi'])
+        return web.json_response({'result': season_flights(pilot_id, year)})
+
+    async def flightstatistics(request):
+        olc_flight_id = int(request.query['dsIds'])
+        return web.json_response([{'mapHref': f'/olc-3.0/gliding/flightmap.html?ref={flight_ref(olc_flight_id)}'}])
+
+    async def flightinfo(request):
+        olc_flight_id = int(request.query['dsId'])
+        return web.Response(content_type='text/html', text=f"""<html><body>
+<div class="OlcButtonBar"><div><div><div class="dropdown-menu"><dl>
+<dt>Aircraft</dt><dd>Stand-in glider</dd><dt>Registration</dt><dd>D{olc_flight_id % 10000:04d}</dd><dt>CID</dt><dd>{olc_flight_id % 100:02d}</dd>
+</dl></div></div></div></div>
+<div class="OlcFlightInfoBox olcfiComment"><blockquote><p>Stand-in flight {olc_flight_id}</p></blockquote></div>
+</body></html>""")
+
+    async def download(request):
+        if 'OLCAUTH' not in request.cookies:
+            return web.Response(status=302, headers={'Location': '/olc-3.0/secure/login.html'})
+        ref = int(request.query['flightId'])
+        return web.Response(body=igc_file(ref), content_type='application/igc')
+
+    app = web.Application(middlewares=[behaviour.middleware])
+    app.add_routes([
+        web.post('/olc-3.0/secure/login.html', login),
+        web.post('/olc-3.0/gliding/flightbook.html', flightbook),
+        web.get('/olc-3.0/gliding/rest/flightstatistics.json', flightstatistics),
+        web.get('/olc-3.0/gliding/flightinfo.html', flightinfo),
+        web.route('*', '/olc-3.0/gliding/download.html', download),
+        web.get('/olc-3.0/_stats', behaviour.stats),
+    ])
+    return app
+
+
+def make_weglide_app(behaviour):
+    uploaded = {}  # (user_id, filename) -> WeGlide flight id
+    flights = {}  # WeGlide flight id -> flight
+
+    async def igcfile(request):
+        form = await request.post()
+        upload = form['file']
+        upload.file.read()
+        key = (form['user_id'], upload.filename)
+        if key in uploaded:
+            return web.json_response({'error': 'already_uploaded', 'error_description': 'Flight already uploaded'}, status=400)
+        weglide_flight_id = len(flights) + 1
+        uploaded[key] = weglide_flight_id
+        flights[weglide_flight_id] = {'id': weglide_flight_id, 'user_id': form['user_id']}
+        response = web.json_response([{'id': weglide_flight_id}], status=201)
+        response.set_cookie(f'edit_flight_{weglide_flight_id}', 'standin')
+        return response
+
+    async def flightdetail(request):
+        if int(request.match_info['flight_id']) not in flights:
+            return web.json_response({'error': 'not_found'}, status=404)
+        flights[int(request.match_info['flight_id'])].update(await request.json())
+        return web.json_response({'id': int(request.match_info['flight_id'])})
+
+    async def comment(request):
+        await request.json()
+        return web.json_response({'id': 1}, status=201)
+
+    async def flight(request):
+        user_flights = [f for f in flights.values() if f['user_id'] == request.query.get('user_id_in')]
+        return web.json_response(user_flights[:1])
+
+    async def aircraft(request):
+        return web.json_response([{'id': glider_id, 'name': name} for name, glider_id in gliders.items()])
+
+    app = web.Application(middlewares=[behaviour.middleware], client_max_size=16 * 1024 ** 2)
+    app.add_routes([
+        web.post('/v1/igcfile', igcfile),
+        web.patch('/v1/flightdetail/{flight_id}', flightdetail),
+        web.post('/v1/comment/flight/{flight_id}', comment),
+        web.get('/v1/flight', flight),
+        web.get('/v1/aircraft', aircraft),
+        web.get('/v1/_stats', behaviour.stats),
+    ])
+    return app
+
+
+async def start(olc_behaviour, weglide_behaviour, host='localhost'):
+    """Start both servers on the running loop, returns the runners to clean up."""
+    runners = []
+    for app, port in ((make_olc_app(olc_behaviour), olc_port), (make_weglide_app(weglide_behaviour), weglide_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+    return runners
+
+
+def behaviour_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.2, help='Median seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.25, help='Sigma of the lognormal latency factor')
+    parser.add_argument('--max-inflight', type=int, default=16, help='Concurrent requests above which 429 is returned')
+    parser.add_argument('--rate', type=float, default=50.0, help='Requests per second above which 429 is returned')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='Fraction of requests failing with 500')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def behaviours(args):
+    olc = Behaviour(args.latency, args.jitter, args.max_inflight, args.rate, args.error_rate, args.seed)
+    weglide = Behaviour(args.latency, args.jitter, args.max_inflight, args.rate, args.error_rate, args.seed + 1)
+    return olc, weglide
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    behaviour_arguments(parser)
+
+    async def main():
+        await start(*behaviours(parser.parse_args()))
+        print(f'OLC stand-in on http://localhost:{olc_port}/olc-3.0/, WeGlide stand-in on http://localhost:{weglide_port}/v1/')
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
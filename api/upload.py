@@ -1,7 +1,6 @@
 import asyncio
 import concurrent.futures
 import logging
-from io import StringIO
 
 import sentry_sdk
 import tornado.ioloop
@@ -10,82 +9,221 @@ from aiohttp import ClientError
 from requests import RequestException
 from sentry_sdk import new_scope
 
-from misc import format_registration, MetricSemaphore, set_upload_status
+from drr_scheduler import lanes
+from igc import IgcFileError, check_igc
+from ledger import record_upload
+from misc import format_registration, set_upload_status
 from olc_interface import OlcInterface, OlcRequestError
+from pipeline import StagedPipeline
 from weglide_interface import interface, WeglideResponseError
 
 loop = tornado.ioloop.IOLoop.current()
 executor = concurrent.futures.ThreadPoolExecutor()
-weglide_semaphore = MetricSemaphore(2)
 
 
-async def upload_flight(flight, weglide_user_id, weglide_dateofbirth, olc_user, olc_password):
-    olc_flight_id = int(flight['id'])
-    set_upload_status(olc_flight_id, 'Processing', 'processing')
+async def in_executor(fn, *args):
+    """Coroutine running a blocking WeGlide call in the executor, only started once its lane dispatches it."""
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+def weglide_rejected(e):
+    """WeGlide refused the request itself, e.g. an already uploaded flight, rather than being overloaded or down."""
+    response = getattr(e, 'response', None)  # requests.HTTPError of raise_for_status
+    status_code = response.status_code if response is not None else getattr(e, 'status_code', None)
+    return status_code is not None and 400 <= status_code < 500 and status_code not in (408, 429)
+
+
+async def _weglide_outcome(fn, *args):
     try:
-        with sentry_sdk.start_span(op='subprocess', name='fetch_olc_igc') as inner_span:
-            try:
-                async with OlcInterface(user=olc_user, password=olc_password) as olc:
-                    flight_ref = await olc.fetch_flight_ref(olc_flight_id)
-                    set_upload_status(olc_flight_id, 'Downloading IGC')
-                    filename, igc_data = await olc.fetch_igc(flight_ref)
-                    file = StringIO(igc_data)
-            except (RequestException, asyncio.TimeoutError) as e:
-                set_upload_status(olc_flight_id, 'Request to OLC failed, try again later')
-                logging.info(f'Error fetching OLC flight {olc_flight_id}: {e} ({type(e).__name__})')
-                return
-            except (ClientError, OlcRequestError, ValueError) as e:
-                set_upload_status(olc_flight_id, 'OLC: ' + str(e) or repr(e))
-                logging.info(f'Error fetching {olc_flight_id} from OLC: {e} ({type(e).__name__})')
-                return
-
-        with sentry_sdk.start_span(op='subprocess', name='upload_weglide') as inner_span:
+        return await in_executor(fn, *args), None
+    except (RequestException, WeglideResponseError) as e:
+        if not weglide_rejected(e):
+            raise
+        return None, e
+
+
+async def submit_weglide(lane, upload, fn, *args):
+    """Run a WeGlide call in its lane, returns its result.
+
+    Rejected requests are returned by the coroutine in the lane and only raised here, so the lane records them
+    as ok and its concurrency follows how WeGlide copes, not how many flights it refuses.
+    """
+    result, rejected = await lanes.submit(lane, upload.weglide_user_id, _weglide_outcome(fn, *args))
+    if rejected:
+        raise rejected
+    return result
+
+
+class Upload:
+    """A flight on its way through the upload stages, each stage adds what the next one needs."""
+    def __init__(self, flight, weglide_user_id, weglide_dateofbirth, olc_user, olc_password, job_ids=(), olc_user_id=None):
+        self.flight = flight
+        self.olc_flight_id = int(flight['id'])
+        self.olc_user_id = olc_user_id  # OLC pilot id, the ledger of uploaded flights is kept per pilot
+        self.weglide_user_id = weglide_user_id
+        self.weglide_dateofbirth = weglide_dateofbirth
+        self.olc_user = olc_user
+        self.olc_password = olc_password
+        self.job_ids = job_ids
+        self.flight_ref = None
+        self.filename = None
+        self.igc_data = None
+        self.weglide_flight_id = None
+        self.olc = None  # OLC session from resolving the flight until its IGC file is downloaded
+        self.result = None; self.state = None  # Last reported, for the jobs that join while it is being uploaded
+
+    async def status(self, result, status=None):
+        self.result = result if result is not None else self.result
+        self.state = status or self.state
+        await set_upload_status(self.olc_flight_id, result, status, job_ids=self.job_ids)
+
+    async def olc_session(self):
+        if self.olc is None:
+            self.olc = OlcInterface(user=self.olc_user, password=self.olc_password)
+            await self.olc.ensure_session()
+        return self.olc
+
+    async def close_olc(self):
+        if self.olc is not None:
+            olc, self.olc = self.olc, None
+            await olc.close()
+
+    async def on_weglide(self, weglide_flight_id):
+        """The flight is on WeGlide, remember it so later migrations skip it."""
+        if self.olc_user_id:
+            await record_upload(self.olc_user_id, self.olc_flight_id, weglide_flight_id)
+
+
+async def olc_failed(upload, e):
+    if isinstance(e, (RequestException, asyncio.TimeoutError)):
+        await upload.status('Request to OLC failed, try again later', 'error')
+        logging.info(f'Error fetching OLC flight {upload.olc_flight_id}: {e} ({type(e).__name__})')
+    else:
+        await upload.status('OLC: ' + str(e) or repr(e), 'error')
+        logging.info(f'Error fetching {upload.olc_flight_id} from OLC: {e} ({type(e).__name__})')
+    return False
+
+
+async def weglide_failed(upload, e):
+    if isinstance(e, RequestException):
+        await upload.status('Request to WeGlide failed, try again later', 'error')
+        logging.info(f'Error uploading OLC flight {upload.olc_flight_id} to WeGlide')
+    elif isinstance(e, TypeError):
+        # Temporary debug
+        with new_scope() as scope:
+            scope.set_extra('flight', upload.flight)
+            sentry_sdk.capture_exception(e)
+        await upload.status(str(e), 'error')
+    else:
+        result = str(e)
+        if hasattr(e, 'error') and e.error == 'already_uploaded':
+            flight = upload.flight
             try:
-                async with weglide_semaphore:
-                    logging.info(f'Uploading IGC for OLC flight {olc_flight_id} to WeGlide')
-                    set_upload_status(olc_flight_id, 'Uploading to WeGlide')
-                    response_json = await loop.run_in_executor(executor, interface.upload_igc, filename, file, weglide_user_id, weglide_dateofbirth)
-                weglide_flight_id = response_json['id']
-                logging.info(f'Done uploading IGC for OLC flight {olc_flight_id} to WeGlide: {weglide_flight_id}')
-                set_upload_status(olc_flight_id, f'<a target="_blank" href="https://www.weglide.org/flight/{weglide_flight_id}">View</a>', 'done')
-                airplane_id = flight['airplane_weglide']['id']
-                interface.patch_flightdata(response_json['id'], {
-                    'registration': format_registration(flight.get('registration')),
-                    'competition_id': flight.get('competition_id'),
-                    'aircraft_id': airplane_id,
-                })
-                if flight.get('co_pilot'):
-                    interface.patch_flightdata(response_json['id'], {'co_user_name': flight.get('co_pilot')})
-                interface.post_comment(weglide_flight_id, flight.get('pilot_comment'))
-            except RequestException as e:
-                set_upload_status(olc_flight_id, 'Request to WeGlide failed, try again later', 'error')
-                logging.info(f'Error uploading OLC flight {olc_flight_id} to WeGlide')
-                return
-            except TypeError as e:
-                # Temporary debug
-                with new_scope() as scope:
-                    scope.set_extra('flight', flight)
-                    sentry_sdk.capture_exception(e)
-                return
-            except WeglideResponseError as e:
-                result = str(e)
-                if hasattr(e, 'error') and e.error == 'already_uploaded':
-                    try:
-                        flight = interface.search_flight(weglide_user_id, flight['date'], format_registration(flight['registration']), flight['distance'])
-                        result = f'<a target="_blank" href="https://www.weglide.org/flight/{flight["id"]}">{result}</a>'
-                    except Exception:
-                        pass
-                set_upload_status(olc_flight_id, 'WeGlide: ' + result, 'error')
-                logging.info(f'Error uploading IGC for OLC flight {olc_flight_id} to WeGlide: {e} ({e.error})')
-                return
-            set_upload_status(olc_flight_id, None, status='done')
-
-    # Handle all other general exceptions
-    except AssertionError as e:
-        set_upload_status(olc_flight_id, str(e), 'error')
-        logging.info(f'Generic problem for {olc_flight_id}: {e}')
-    except Exception as e:
+                flight = await submit_weglide('weglide_meta', upload,
+                    interface.search_flight, upload.weglide_user_id, flight['date'], format_registration(flight['registration']), flight['distance'])
+                result = f'<a target="_blank" href="https://www.weglide.org/flight/{flight["id"]}">{result}</a>'
+                await upload.on_weglide(flight['id'])
+            except Exception:
+                pass
+        await upload.status('WeGlide: ' + result, 'error')
+        logging.info(f'Error uploading IGC for OLC flight {upload.olc_flight_id} to WeGlide: {e} ({e.error})')
+    return False
+
+
+async def upload_failed(upload, e):
+    """Any other problem in a stage, the pipeline calls this with what the stage raised."""
+    if isinstance(e, AssertionError):
+        await upload.status(str(e), 'error')
+        logging.info(f'Generic problem for {upload.olc_flight_id}: {e}')
+    else:
         # Alert every other problems
         sentry_sdk.capture_exception(e)
-        set_upload_status(olc_flight_id, str(e), 'error')
-        logging.info(f'Unknown error while uploading IGC for OLC flight {olc_flight_id} to WeGlide: {e}')
+        await upload.status(str(e), 'error')
+        logging.info(f'Unknown error while uploading IGC for OLC flight {upload.olc_flight_id} to WeGlide: {e}')
+
+
+async def resolve_ref(upload):
+    await upload.status('Processing', 'processing')
+    with sentry_sdk.start_span(op='subprocess', name='fetch_olc_flight_ref'):
+        try:
+            olc = await upload.olc_session()
+            upload.flight_ref = await lanes.submit('olc_json', upload.weglide_user_id, olc.fetch_flight_ref(upload.olc_flight_id))
+        except (RequestException, asyncio.TimeoutError, ClientError, OlcRequestError, ValueError) as e:
+            await upload.close_olc()
+            return await olc_failed(upload, e)
+
+
+async def download_igc(upload):
+    await upload.status('Downloading IGC')
+    with sentry_sdk.start_span(op='subprocess', name='fetch_olc_igc'):
+        try:
+            olc = await upload.olc_session()
+            upload.filename, upload.igc_data = await lanes.submit('olc_igc', upload.weglide_user_id, olc.fetch_igc(upload.flight_ref))
+        except (RequestException, asyncio.TimeoutError, ClientError, OlcRequestError, ValueError) as e:
+            return await olc_failed(upload, e)
+        finally:
+            await upload.close_olc()  # The later stages only talk to WeGlide
+
+
+async def validate_igc(upload):
+    """Reject files WeGlide would refuse or that are not the OLC flight, before transferring them."""
+    with sentry_sdk.start_span(op='subprocess', name='check_igc') as span:
+        try:
+            summary = await loop.run_in_executor(executor, check_igc, upload.igc_data, upload.flight)  # Off the IOLoop, large files take a while
+        except IgcFileError as e:
+            span.set_data('igc_rejected', 1)
+            await upload.status(f'IGC: {e}', 'error')
+            logging.info(f'Rejected IGC of OLC flight {upload.olc_flight_id}: {e}')
+            return False
+        span.set_data('igc_fixes', summary['fixes'])
+        span.set_data('igc_takeoffs', summary['takeoffs'])
+        if summary['warnings']:
+            # Uploaded anyway, WeGlide decides, but worth knowing when it fails there
+            span.set_data('igc_warnings', summary['warnings'])
+            logging.info(f'IGC of OLC flight {upload.olc_flight_id}: {", ".join(summary["warnings"])}')
+
+
+async def upload_igc(upload):
+    with sentry_sdk.start_span(op='subprocess', name='upload_weglide'):
+        try:
+            logging.info(f'Uploading IGC for OLC flight {upload.olc_flight_id} to WeGlide')
+            await upload.status('Uploading to WeGlide')
+            response_json = await submit_weglide('weglide_upload', upload,
+                interface.upload_igc, upload.filename, upload.igc_data, upload.weglide_user_id, upload.weglide_dateofbirth)
+            upload.igc_data = None  # Not needed anymore, do not hold it while waiting for the next stage
+            upload.weglide_flight_id = response_json['id']
+            await upload.on_weglide(upload.weglide_flight_id)
+            logging.info(f'Done uploading IGC for OLC flight {upload.olc_flight_id} to WeGlide: {upload.weglide_flight_id}')
+            await upload.status(f'<a target="_blank" href="https://www.weglide.org/flight/{upload.weglide_flight_id}">View</a>', 'done')
+        except (RequestException, TypeError, WeglideResponseError) as e:
+            return await weglide_failed(upload, e)
+
+
+async def enrich(upload):
+    flight = upload.flight
+    with sentry_sdk.start_span(op='subprocess', name='enrich_weglide'):
+        try:
+            await submit_weglide('weglide_meta', upload, interface.patch_flightdata, upload.weglide_flight_id, {
+                'registration': format_registration(flight.get('registration')),
+                'competition_id': flight.get('competition_id'),
+                'aircraft_id': flight['airplane_weglide']['id'],
+            })
+            if flight.get('co_pilot'):
+                await submit_weglide('weglide_meta', upload,
+                    interface.patch_flightdata, upload.weglide_flight_id, {'co_user_name': flight.get('co_pilot')})
+            await submit_weglide('weglide_meta', upload,
+                interface.post_comment, upload.weglide_flight_id, flight.get('pilot_comment'))
+        except (RequestException, TypeError, WeglideResponseError) as e:
+            return await weglide_failed(upload, e)
+        await upload.status(None, status='done')
+
+
+# Each upstream step is a stage with its own workers, so IGC downloads of the next flights overlap the WeGlide
+# upload of this one. The lanes still share each upstream fairly between users and with the flight listings.
+upload_pipeline = StagedPipeline([
+    ('resolve', resolve_ref, 8),
+    ('download', download_igc, 8),
+    ('check', validate_igc, 2),
+    ('upload', upload_igc, 2),  # Never more than 2 uploads to WeGlide at once, like its lane
+    ('enrich', enrich, 4),
+], queue_size=16, key=lambda upload: upload.weglide_user_id, on_error=upload_failed)
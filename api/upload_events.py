@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from app import redis_client
+from upload_jobs import upload_events_prefix
+
+
+class UploadEventHub:
+    """Fan out upload status events from Redis pub/sub to the streams connected to this process.
+
+    One pattern subscription per process instead of a Redis connection per connected browser.
+    """
+    def __init__(self, max_queued=1000):
+        self.max_queued = max_queued
+        self.subscribers = defaultdict(set)  # job_id -> set of queues
+        self.listener = None
+
+    def subscribe(self, job_id):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.ensure_future(self._listen())
+        queue = asyncio.Queue(maxsize=self.max_queued)
+        self.subscribers[job_id].add(queue)
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        self.subscribers[job_id].discard(queue)
+        if not self.subscribers[job_id]:
+            del self.subscribers[job_id]
+
+    async def _listen(self):
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.psubscribe(f'{upload_events_prefix}*')
+                async for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    job_id = message['channel'][len(upload_events_prefix):]
+                    for queue in self.subscribers.get(job_id, ()):
+                        try:
+                            queue.put_nowait(message['data'])
+                        except asyncio.QueueFull:
+                            logging.warning(f'Dropping upload event for slow stream of job {job_id}')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'Upload event listener failed: {e}')
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+
+upload_event_hub = UploadEventHub()
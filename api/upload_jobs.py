@@ -0,0 +1,127 @@
+import json
+import time
+import uuid
+
+from app import redis_client
+
+upload_events_prefix = 'upload_events:'  # Pub/sub channel per upload job
+job_active_expiry_seconds = 60 * 60 * 24  # Refreshed on every update while flights are still processing
+job_finished_expiry_seconds = 60 * 60  # Keep the result around for a while after the last flight finished
+
+# Update one flight of a job, keep the status counters in sync and publish the change, in a single round trip.
+# KEYS[1] job key, ARGV: flight_id, result, status, now, active expiry, finished expiry, events channel
+_update_flight_script = redis_client.register_script("""
+local field = 'f:' .. ARGV[1]
+local current = redis.call('HGET', KEYS[1], field)
+if not current then
+    return 0
+end
+local flight = cjson.decode(current)
+local previous = flight['status']
+if ARGV[2] ~= '' then flight['result'] = ARGV[2] end
+if ARGV[3] ~= '' then flight['status'] = ARGV[3] end
+redis.call('HSET', KEYS[1], field, cjson.encode(flight), 'updated', ARGV[4])
+if previous ~= flight['status'] then
+    redis.call('HINCRBY', KEYS[1], 'n:' .. previous, -1)
+    redis.call('HINCRBY', KEYS[1], 'n:' .. flight['status'], 1)
+    if tonumber(redis.call('HGET', KEYS[1], 'n:processing')) == 0 then
+        redis.call('HSET', KEYS[1], 'finished', ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[6])
+    else
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+    end
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+end
+local event = {id = ARGV[1]}
+if ARGV[2] ~= '' then event['result'] = ARGV[2] end
+if ARGV[3] ~= '' then event['status'] = ARGV[3] end
+redis.call('PUBLISH', ARGV[7], cjson.encode(event))
+return 1
+""")
+
+
+def _job_key(job_id):
+    return f'upload_job:{job_id}'
+
+
+async def claim_idempotency_key(weglide_user_id, key, job_id):
+    """Bind a client supplied idempotency key to job_id, returns the job id bound earlier if there is one."""
+    redis_key = f'upload_idempotency:{weglide_user_id}:{key}'
+    if await redis_client.set(redis_key, job_id, nx=True, ex=job_active_expiry_seconds):
+        return None
+    return await redis_client.get(redis_key)
+
+
+async def create_upload_job(weglide_user_id, flight_ids, job_id=None):
+    """Create a job holding the state of every flight, returns the job id."""
+    job_id = job_id or uuid.uuid4().hex
+    flight_ids = list(dict.fromkeys(flight_ids))  # Each flight counts once, or n:processing never gets to 0
+    mapping = {f'f:{flight_id}': json.dumps({'status': 'processing', 'result': 'Pending'}) for flight_id in flight_ids}
+    mapping.update({
+        'weglide_user_id': weglide_user_id or '',
+        'total': len(flight_ids),
+        'n:processing': len(flight_ids),
+        'n:done': 0,
+        'n:error': 0,
+        'n:cancelled': 0,
+        'created': time.time(),
+    })
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping=mapping)
+        pipe.expire(_job_key(job_id), job_active_expiry_seconds)
+        await pipe.execute()
+    return job_id
+
+
+async def delete_upload_job(job_id):
+    await redis_client.delete(_job_key(job_id))
+
+
+async def set_job_flight_status(job_id, flight_id, result, status=None):
+    return await _update_flight_script(keys=[_job_key(job_id)], args=[
+        flight_id, result if result is not None else '', status or '', time.time(),
+        job_active_expiry_seconds, job_finished_expiry_seconds, f'{upload_events_prefix}{job_id}',
+    ])
+
+
+def _eta_seconds(job):
+    remaining = job['processing']
+    finished = job['total'] - remaining
+    if not remaining:
+        return 0
+    if not finished:
+        return None
+    elapsed = time.time() - job['created']
+    return round(elapsed / finished * remaining)
+
+
+async def get_upload_job(job_id):
+    """Counters, ETA and per flight state of a job, None when unknown or expired."""
+    fields = await redis_client.hgetall(_job_key(job_id))
+    if not fields:
+        return None
+    job = {
+        'job_id': job_id,
+        'weglide_user_id': fields['weglide_user_id'],
+        'total': int(fields['total']),
+        'processing': int(fields['n:processing']),
+        'done': int(fields['n:done']),
+        'error': int(fields['n:error']),
+        'cancelled': int(fields.get('n:cancelled', 0)),
+        'created': float(fields['created']),
+        'finished': float(fields['finished']) if 'finished' in fields else None,
+        'flights': {
+            int(field[2:]): json.loads(value) for field, value in fields.items() if field.startswith('f:')
+        },
+    }
+    job['eta_seconds'] = _eta_seconds(job)
+    return job
+
+
+async def get_upload_job_progress(job_id):
+    """Only the counters of a job, without reading the state of every flight."""
+    weglide_user_id, total, processing = await redis_client.hmget(_job_key(job_id), 'weglide_user_id', 'total', 'n:processing')
+    if total is None:
+        return None
+    return {'weglide_user_id': weglide_user_id, 'total': int(total), 'processing': int(processing)}
@@ -0,0 +1,395 @@
+"""Durable upload queue in Redis, consumed by every API process and by standalone workers.
+
+Run a worker without the API: python upload_queue.py
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from app import local, redis_client
+from drr_scheduler import drr_scheduler, lanes
+from misc import set_upload_status
+from upload import Upload, upload_pipeline
+from upload_jobs import get_upload_job_progress
+
+queue_prefix = 'upload_queue:'
+visibility_timeout_seconds = 5 * 60  # Claimed uploads not acked or extended in time are handed out again
+descriptor_expiry_seconds = 60 * 60 * 24  # Descriptors hold OLC credentials, never keep them longer than this
+max_attempts = 3  # Deliveries before an upload is given up, e.g. when it keeps crashing its worker
+rate_window_minutes = 5  # Completion rate used for the ETA
+
+# OLC passwords in queued descriptors are encrypted, Redis (and its dumps and replicas) never holds them in plaintext.
+# Every API and worker process needs the same key, and it must stay the same across restarts, see .env-default.
+if os.environ.get('UPLOAD_CREDENTIALS_KEY'):
+    credentials_cipher = Fernet(os.environ['UPLOAD_CREDENTIALS_KEY'])
+elif local:
+    logging.warning('UPLOAD_CREDENTIALS_KEY not set, using a random key, queued uploads cannot be read after a restart')
+    credentials_cipher = Fernet(Fernet.generate_key())
+else:
+    raise RuntimeError('UPLOAD_CREDENTIALS_KEY is not set, queued uploads could not be read after a restart, see .env-default')
+
+# Redis layout, all under queue_prefix:
+#   ring             list of users with queued uploads, rotated on every claim (round robin between users)
+#   active           set of the users in ring
+#   user:<user>      list of queued upload ids of a user
+#   item:<id>        descriptor of an upload, id is <user>:<OLC flight id>, expires with the (encrypted) credentials in it
+#   jobs:<id>        set of the upload jobs following a queued or inflight upload, resubmissions merge into it
+#   inflight         zset of claimed upload ids, scored by visibility deadline
+#   attempts         hash of upload id -> deliveries
+#   notify           wakes a waiting worker after enqueue or requeue
+#   queued           number of queued uploads of all users
+#   acked:<minute>   uploads finished in that minute by all workers
+
+# Queue uploads of one job, an upload that is already queued or being uploaded gets the job as extra follower instead.
+# ARGV: prefix, user, job id, expiry, then id and descriptor pairs.
+# Returns {queued, merged, ids already being uploaded...}
+_enqueue_script = redis_client.register_script("""
+local prefix, user, job_id = ARGV[1], ARGV[2], ARGV[3]
+local queued, merged, inflight = 0, 0, {}
+for i = 5, #ARGV, 2 do
+    local id = ARGV[i]
+    local jobs_key = prefix .. 'jobs:' .. id
+    if redis.call('ZSCORE', prefix .. 'inflight', id) then
+        -- Claimed before this job joined, it gets the outcome when the upload is acked
+        redis.call('SADD', jobs_key, job_id)
+        table.insert(inflight, id)
+    elseif redis.call('EXISTS', prefix .. 'item:' .. id) == 1 then
+        redis.call('SADD', jobs_key, job_id)
+        merged = merged + 1
+    else
+        redis.call('SET', prefix .. 'item:' .. id, ARGV[i + 1], 'EX', ARGV[4])
+        redis.call('DEL', jobs_key)
+        redis.call('SADD', jobs_key, job_id)
+        redis.call('EXPIRE', jobs_key, ARGV[4])
+        redis.call('RPUSH', prefix .. 'user:' .. user, id)
+        queued = queued + 1
+    end
+end
+if queued > 0 then
+    if redis.call('SADD', prefix .. 'active', user) == 1 then
+        redis.call('RPUSH', prefix .. 'ring', user)
+    end
+    redis.call('INCRBY', prefix .. 'queued', queued)
+    redis.call('LPUSH', prefix .. 'notify', 1)
+    redis.call('LTRIM', prefix .. 'notify', 0, 0)
+end
+return {queued, merged, unpack(inflight)}
+""")
+
+# Remove a job from queued uploads of a user, uploads no other job follows anymore are dropped.
+# Uploads already claimed cannot be cancelled. ARGV: prefix, user, job id, then ids. Returns the cancelled ids.
+_cancel_script = redis_client.register_script("""
+local prefix, user, job_id = ARGV[1], ARGV[2], ARGV[3]
+local user_key = prefix .. 'user:' .. user
+local cancelled = {}
+for i = 4, #ARGV do
+    local id = ARGV[i]
+    local jobs_key = prefix .. 'jobs:' .. id
+    if not redis.call('ZSCORE', prefix .. 'inflight', id) and redis.call('SREM', jobs_key, job_id) == 1 then
+        table.insert(cancelled, id)
+        if redis.call('SCARD', jobs_key) == 0 and redis.call('LREM', user_key, 1, id) == 1 then
+            redis.call('DEL', prefix .. 'item:' .. id)
+            redis.call('HDEL', prefix .. 'attempts', id)
+            redis.call('DECR', prefix .. 'queued')
+        end
+    end
+end
+if redis.call('LLEN', user_key) == 0 and redis.call('SREM', prefix .. 'active', user) == 1 then
+    redis.call('LREM', prefix .. 'ring', 1, user)
+end
+return cancelled
+""")
+
+# Take the next upload of the next user in the ring and mark it inflight until the visibility deadline.
+# ARGV: prefix, visibility deadline. Returns {id, descriptor, attempts, job ids...} or nil when the queue is empty.
+_claim_script = redis_client.register_script("""
+local prefix = ARGV[1]
+while true do
+    local user = redis.call('LMOVE', prefix .. 'ring', prefix .. 'ring', 'LEFT', 'RIGHT')
+    if not user then
+        return nil
+    end
+    local user_key = prefix .. 'user:' .. user
+    local id = redis.call('LPOP', user_key)
+    if redis.call('LLEN', user_key) == 0 then
+        redis.call('LREM', prefix .. 'ring', -1, user)
+        redis.call('SREM', prefix .. 'active', user)
+    end
+    if id then
+        redis.call('DECR', prefix .. 'queued')
+        local descriptor = redis.call('GET', prefix .. 'item:' .. id)
+        if descriptor then
+            redis.call('ZADD', prefix .. 'inflight', ARGV[2], id)
+            local attempts = redis.call('HINCRBY', prefix .. 'attempts', id, 1)
+            return {id, descriptor, attempts, unpack(redis.call('SMEMBERS', prefix .. 'jobs:' .. id))}
+        end
+        -- Expired together with its credentials, skip it
+        redis.call('HDEL', prefix .. 'attempts', id)
+    end
+end
+""")
+
+# Put uploads whose visibility deadline passed back in front of their user's queue.
+# ARGV: prefix, now. Returns the number of requeued uploads.
+_reap_script = redis_client.register_script("""
+local prefix = ARGV[1]
+local ids = redis.call('ZRANGEBYSCORE', prefix .. 'inflight', '-inf', ARGV[2], 'LIMIT', 0, 100)
+local requeued = 0
+for _, id in ipairs(ids) do
+    redis.call('ZREM', prefix .. 'inflight', id)
+    local descriptor = redis.call('GET', prefix .. 'item:' .. id)
+    if descriptor then
+        local user = cjson.decode(descriptor)['user']
+        redis.call('LPUSH', prefix .. 'user:' .. user, id)
+        if redis.call('SADD', prefix .. 'active', user) == 1 then
+            redis.call('RPUSH', prefix .. 'ring', user)
+        end
+        redis.call('INCR', prefix .. 'queued')
+        requeued = requeued + 1
+    else
+        redis.call('HDEL', prefix .. 'attempts', id)
+    end
+end
+if requeued > 0 then
+    redis.call('LPUSH', prefix .. 'notify', 1)
+    redis.call('LTRIM', prefix .. 'notify', 0, 0)
+end
+return requeued
+""")
+
+
+class UploadQueue:
+    """Per-user round robin queue of upload descriptors with visibility timeouts and acknowledgements."""
+    def __init__(self, prefix=queue_prefix, visibility_timeout=visibility_timeout_seconds):
+        self.prefix = prefix
+        self.visibility_timeout = visibility_timeout
+
+    @staticmethod
+    def upload_id(user, flight_id):
+        # One queued upload per WeGlide user and OLC flight, whoever submits it how often
+        return f'{user}:{flight_id}'
+
+    async def enqueue(self, user, job_id, uploads):
+        """Queue upload descriptors of one job in order, returns (queued, merged, ids already being uploaded)."""
+        args = [self.prefix, user, job_id, descriptor_expiry_seconds]
+        for upload in uploads:
+            upload = dict(upload, user=str(user))
+            upload['olc_password'] = credentials_cipher.encrypt((upload['olc_password'] or '').encode()).decode()
+            args += [self.upload_id(user, upload['flight']['id']), json.dumps(upload)]
+        queued, merged, *inflight = await _enqueue_script(args=args)
+        return queued, merged, inflight
+
+    async def cancel(self, user, job_id, flight_ids):
+        """Drop the job from the given queued flights, returns the OLC flight ids cancelled for it."""
+        cancelled = await _cancel_script(args=[self.prefix, user, job_id] + [self.upload_id(user, f) for f in flight_ids])
+        return [int(upload_id.rpartition(':')[2]) for upload_id in cancelled]
+
+    async def claim(self):
+        """Next upload as (id, descriptor, attempts, job ids), None when nothing is queued."""
+        claimed = await _claim_script(args=[self.prefix, time.time() + self.visibility_timeout])
+        if claimed is None:
+            return None
+        upload_id, descriptor, attempts, *job_ids = claimed
+        return upload_id, json.loads(descriptor), int(attempts), job_ids
+
+    async def extend(self, upload_id):
+        """Push the visibility deadline of a claimed upload forward while still working on it."""
+        await redis_client.zadd(f'{self.prefix}inflight', {upload_id: time.time() + self.visibility_timeout}, xx=True)
+
+    async def ack(self, upload_id):
+        """Done with a claimed upload, returns the ids of the jobs following it, also those that joined after the claim."""
+        acked_key = f'{self.prefix}acked:{int(time.time() // 60)}'
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.smembers(f'{self.prefix}jobs:{upload_id}')
+            pipe.zrem(f'{self.prefix}inflight', upload_id)
+            pipe.delete(f'{self.prefix}item:{upload_id}', f'{self.prefix}jobs:{upload_id}')
+            pipe.hdel(f'{self.prefix}attempts', upload_id)
+            pipe.incr(acked_key)
+            pipe.expire(acked_key, (rate_window_minutes + 1) * 60)
+            job_ids, *_ = await pipe.execute()
+        return job_ids
+
+    async def reap(self):
+        return await _reap_script(args=[self.prefix, time.time()])
+
+    async def wait(self, timeout=1):
+        """Block until something is enqueued or requeued, or the timeout passed."""
+        await redis_client.blpop(f'{self.prefix}notify', timeout=timeout)
+
+    async def completion_rate(self):
+        """Uploads finished per second by all workers over the last few minutes."""
+        now = time.time()
+        minute = int(now // 60)
+        keys = [f'{self.prefix}acked:{m}' for m in range(minute - rate_window_minutes, minute + 1)]
+        acked = sum(int(count) for count in await redis_client.mget(keys) if count)
+        return acked / (rate_window_minutes * 60 + now % 60)
+
+    async def position(self, user):
+        """Where the uploads of a user are in the queue, from counters only.
+
+        Claims alternate between users, so until the user's own uploads are done, each other user
+        gets at most as many uploads ahead as the user has queued.
+        """
+        user = str(user)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.llen(f'{self.prefix}user:{user}')
+            pipe.get(f'{self.prefix}queued')
+            pipe.scard(f'{self.prefix}active')
+            pipe.lpos(f'{self.prefix}ring', user)
+            own, queued, users, ring_index = await pipe.execute()
+        queued = int(queued or 0)
+        return {
+            'queued': own,
+            'items_ahead': min(queued - own, (users - 1) * own) if own else 0,
+            'queue_position': ring_index + 1 if ring_index is not None else None,  # Turn of the user in the rotation
+            'active_users': users,
+        }
+
+    async def stats(self):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.scard(f'{self.prefix}active')
+            pipe.zcard(f'{self.prefix}inflight')
+            pipe.get(f'{self.prefix}queued')
+            users, inflight, queued = await pipe.execute()
+        return {'users': users, 'inflight': inflight, 'queued': int(queued or 0)}
+
+
+class UploadQueueWorker:
+    """Claim uploads while the local scheduler has capacity and ack them once handled.
+
+    The scheduler decides, fairly between users, which uploads are in the pipeline, the stages of the
+    pipeline limit the concurrency of each upstream step.
+    An upload of a worker that dies is handed out again after the visibility timeout.
+    """
+    def __init__(self, queue, scheduler, pipeline, reap_interval=30):
+        self.queue = queue
+        self.scheduler = scheduler
+        self.pipeline = pipeline
+        self.reap_interval = reap_interval
+        self.reaped_at = 0
+        self.tasks = set()
+        self.capacity = asyncio.Event()  # Set when a local upload finished
+
+    def _full(self):
+        return self.scheduler.inflight + self.scheduler.queued >= self.scheduler.adaptive.cap
+
+    async def run(self):
+        while True:
+            try:
+                if time.monotonic() - self.reaped_at > self.reap_interval:
+                    self.reaped_at = time.monotonic()
+                    if requeued := await self.queue.reap():
+                        logging.warning(f'Requeued {requeued} uploads not acked within the visibility timeout')
+                if self._full():
+                    self.capacity.clear()
+                    try:
+                        await asyncio.wait_for(self.capacity.wait(), timeout=self.reap_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                claimed = await self.queue.claim()
+                if claimed is None:
+                    await self.queue.wait()
+                    continue
+                task = asyncio.ensure_future(self._process(*claimed))
+                self.tasks.add(task)  # Keep a reference, the event loop only holds weak ones
+                task.add_done_callback(self._done)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'Upload queue worker failed: {e}')
+                await asyncio.sleep(1)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self.capacity.set()
+
+    async def _heartbeat(self, upload_id):
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            await self.queue.extend(upload_id)
+
+    async def _ack(self, upload_id, flight_id, job_ids, result, status):
+        """Ack the upload and tell the jobs that joined while it was being uploaded how it ended."""
+        joined = [job_id for job_id in await self.queue.ack(upload_id) if job_id not in job_ids]
+        if joined:
+            await set_upload_status(flight_id, result, status, job_ids=joined)
+
+    async def _process(self, upload_id, upload, attempts, job_ids):
+        flight_id = int(upload['flight']['id'])
+        if attempts > max_attempts:
+            logging.error(f'Giving up on upload {upload_id} after {attempts - 1} attempts')
+            result = 'Upload failed repeatedly, try again later'
+            await set_upload_status(flight_id, result, 'error', job_ids=job_ids)
+            await self._ack(upload_id, flight_id, job_ids, result, 'error')
+            return
+        try:
+            olc_password = credentials_cipher.decrypt(upload['olc_password'].encode(), ttl=descriptor_expiry_seconds).decode()
+        except (InvalidToken, AttributeError):
+            # Encrypted with the key of another deployment, or expired
+            logging.error(f'Could not decrypt the OLC credentials of upload {upload_id}')
+            result = 'Could not read the queued OLC credentials, try again'
+            await set_upload_status(flight_id, result, 'error', job_ids=job_ids)
+            await self._ack(upload_id, flight_id, job_ids, result, 'error')
+            return
+        user = upload['user']
+        upload = Upload(
+            upload['flight'], upload['weglide_user_id'], upload['weglide_dateofbirth'],
+            upload['olc_user'], olc_password, job_ids, upload.get('olc_user_id'),
+        )
+        heartbeat = asyncio.ensure_future(self._heartbeat(upload_id))
+        try:
+            await self.scheduler.enqueue_one(user, self.pipeline.process(upload), op='upload')
+        except Exception as e:
+            # The stages report their failures in the status, retrying will not help
+            logging.error(f'Upload {upload_id} failed: {e}')
+        finally:
+            heartbeat.cancel()
+            await upload.close_olc()  # Stopped before the download stage closed it
+        # Not reached when cancelled on shutdown, the upload is handed out again after the visibility timeout
+        await self._ack(upload_id, flight_id, job_ids, upload.result, upload.state)
+
+
+upload_queue = UploadQueue()
+upload_worker = UploadQueueWorker(upload_queue, drr_scheduler, upload_pipeline)
+
+
+async def get_upload_eta(job_id):
+    """Queue position, effective rate and p50/p90 ETA of the unfinished uploads of a job, None when unknown."""
+    progress = await get_upload_job_progress(job_id)
+    if progress is None:
+        return None
+    user = progress['weglide_user_id']
+    remaining = progress['processing']  # Queued and being uploaded
+    position = await upload_queue.position(user)
+    # Uploads finished recently by all processes, else what the slowest stage of this process can do
+    rate = await upload_queue.completion_rate() or upload_pipeline.throughput()
+    _, s50, s90, _ = drr_scheduler.service_times('upload')
+    spread = s90 / s50 if s50 and s90 else 1.5
+    if rate:
+        effective_rate = rate / max(1, position['active_users'])
+        eta_p50 = (position['items_ahead'] + remaining) / rate
+        eta_p90 = eta_p50 * spread
+    else:
+        # Nothing finished recently, estimate from the scheduler of this process
+        concurrency, _ = drr_scheduler.user_effective_rate(user)
+        s_mean = drr_scheduler.service_times('upload')[0]
+        effective_rate = concurrency / s_mean if s_mean else None
+        eta_p50, eta_p90 = drr_scheduler.eta_seconds(user, position['items_ahead'] + remaining, op='upload')
+    return dict(position, job_id=job_id, remaining=remaining, effective_rate=effective_rate,
+                eta_p50_seconds=round(eta_p50) if remaining else 0, eta_p90_seconds=round(eta_p90) if remaining else 0)
+
+
+if __name__ == '__main__':
+    import tornado.ioloop
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.spawn_callback(drr_scheduler.run)
+    io_loop.spawn_callback(lanes.run)
+    io_loop.spawn_callback(upload_pipeline.run)
+    io_loop.spawn_callback(upload_worker.run)
+    io_loop.start()
@@ -1,6 +1,5 @@
 import logging
 from datetime import date
-from typing import TextIO
 
 import os
 import requests
@@ -15,10 +14,11 @@ from misc import make_link_if_url
 
 
 class WeglideResponseError(Exception):
-    def __init__(self, *args, error=None, error_description=None, **kwargs):
+    def __init__(self, *args, error=None, error_description=None, status_code=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.error = error
         self.error_description = error_description
+        self.status_code = status_code
 
 
 class WeglideInterface:
@@ -37,7 +37,7 @@ class WeglideInterface:
         except KeyError:
             raise ValueError("Fill your USER_AGENT_EMAIL in the .env file")
 
-        self.base = 'https://api.weglide.org/v1/'
+        self.base = os.environ.get('WEGLIDE_BASE_URL') or 'https://api.weglide.org/v1/'
         self.session = requests.Session()
         self.session.headers = {
             'user-agent': f'OLCtoWeglide ({user_agent_email})',
@@ -54,19 +54,21 @@ class WeglideInterface:
         self.cookie_jar.update(response.cookies)
         self.session.cookies.clear()
 
-    def set_flight_cookie(self, flight_id: int):
+    def flight_cookies(self, flight_id: int):
+        """Edit cookie of a flight for a single request, the session is shared by the executor threads."""
         cookie_name = f'edit_flight_{flight_id}'
         if cookie_name in self.cookie_jar:
-            self.session.cookies.update({cookie_name: self.cookie_jar[cookie_name]})
-
-    def upload_igc(self, filename: str, file: TextIO, user_id: int, date_of_birth: str):
-        # TODO: verify IGC data against OLC to detect differences
+            return {cookie_name: self.cookie_jar[cookie_name]}
+        return {}
 
+    def upload_igc(self, filename: str, igc_data: bytes, user_id: int, date_of_birth: str):
+        # IGC data is checked against the OLC flight before, see igc.check_igc.
+        # The bytes from OLC go into the multipart body as they are, without decoding and encoding them again.
         with sentry_sdk.start_span(op='request', name='upload_igc') as span:
             span.set_data('upload_igc_user', user_id)
             span.set_data('upload_igc_date_of_birth', date_of_birth)
             span.set_data('upload_igc_filename', filename)
-            response = self.session.post(self.base + 'igcfile', files={'file': (filename, file)}, data={
+            response = self.session.post(self.base + 'igcfile', files={'file': (filename, igc_data)}, data={
                 'user_id': user_id,
                 'date_of_birth': date_of_birth,
             })
@@ -96,7 +98,7 @@ class WeglideInterface:
                         span.set_data('upload_igc_already_uploaded', 1)
                         raise WeglideResponseError(
                             f'{error or error_description or response.text}',
-                            error=error, error_description=error_description
+                            error=error, error_description=error_description, status_code=response.status_code
                         ) from e
                     except JSONDecodeError:
                         pass
@@ -106,7 +108,7 @@ class WeglideInterface:
                     capture_exception(e)
                     raise WeglideResponseError(
                         'WeGlide could not process the request, problem has been reported. Try again later',
-                        error_description=response.text
+                        error_description=response.text, status_code=response.status_code
                     ) from e
             # WeGlide splits into multiple flights when detecting multiple takeoffs
             # Just reference the first flight for now
@@ -117,11 +119,10 @@ class WeglideInterface:
         with sentry_sdk.start_span(op='request', name='post_comment') as span:
             if not comment:
                 return
-            self.set_flight_cookie(flight_id)
             response = self.session.post(f'{self.base}comment/flight/{flight_id}', json={
                 'comment': comment,
                 'pinned': True
-            })
+            }, cookies=self.flight_cookies(flight_id))
             response.raise_for_status()
 
     def search(self, documents, search_items, limit=1):
@@ -164,8 +165,8 @@ class WeglideInterface:
 
     def patch_flightdata(self, flight_id, data):
         with sentry_sdk.start_span(op='request', name='patch_flightdata') as span:
-            self.set_flight_cookie(flight_id)
-            response = self.session.patch(f'{self.base}flightdetail/{flight_id}', json={k: v for k, v in data.items() if v})
+            response = self.session.patch(f'{self.base}flightdetail/{flight_id}', json={k: v for k, v in data.items() if v},
+                                          cookies=self.flight_cookies(flight_id))
             if response.status_code != 200:
                 if response.text:
                     try:
@@ -176,9 +177,9 @@ class WeglideInterface:
                     error_description = json_response.get('error_description')
                     raise WeglideResponseError(
                         f'Status {response.status_code}: {error or response.text}',
-                        error=error, error_description=error_description
+                        error=error, error_description=error_description, status_code=response.status_code
                     )
-                raise WeglideResponseError(f'Status {response.status_code}: could not set flightdata')
+                raise WeglideResponseError(f'Status {response.status_code}: could not set flightdata', status_code=response.status_code)
 
     def get_user(self, user_id):
         with sentry_sdk.start_span(op='request', name='get_user') as span:
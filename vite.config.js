@@ -28,6 +28,26 @@ export default defineConfig({
         changeOrigin: true,
         rewrite: path => path.replace(/^\/api\/upload_status/, '/upload_status')
       },
+      '/api/upload_job': {
+        target: 'http://localhost:${VITE_API_PORT}',
+        changeOrigin: true,
+        rewrite: path => path.replace(/^\/api\/upload_job/, '/upload_job')
+      },
+      '/api/upload_eta': {
+        target: 'http://localhost:${VITE_API_PORT}',
+        changeOrigin: true,
+        rewrite: path => path.replace(/^\/api\/upload_eta/, '/upload_eta')
+      },
+      '/api/upload_cancel': {
+        target: 'http://localhost:${VITE_API_PORT}',
+        changeOrigin: true,
+        rewrite: path => path.replace(/^\/api\/upload_cancel/, '/upload_cancel')
+      },
+      '/api/upload_events': {
+        target: 'http://localhost:${VITE_API_PORT}',
+        changeOrigin: true,
+        rewrite: path => path.replace(/^\/api\/upload_events/, '/upload_events')
+      },
       '/api/upload_flights': {
         target: 'http://localhost:${VITE_API_PORT}',
         changeOrigin: true,